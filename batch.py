@@ -0,0 +1,105 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout, redirect_stderr
+import argparse, glob, json, os, re, time, traceback
+from lib import atomic_open, clear_schemas
+import main
+
+# Parse many Mac Address Book files (.abbu) into JSON at once, each into its own output dir,
+# using a pool of processes. See README.md for details.
+
+def batch():
+    parser = argparse.ArgumentParser(description='Parse many .abbu files into JSON, in parallel. See README.md for details.',
+                                     parents=[main.make_parser(add_help=False)])
+    parser.add_argument('archives', nargs='+',
+        help="The .abbu dirs to parse, or globs like 'backups/**/*.abbu'.")
+    parser.add_argument('--out', type=Path, default=Path('./out'),
+        help="Put each archive's output in its own subdir of this dir. (default: ./out)")
+    parser.add_argument('--procs', '-P', type=int, default=os.cpu_count(), metavar='N',
+        help='Parse N archives at once, each in its own process. (default: # of CPUs)')
+    args = parser.parse_args()
+    main.check_args(parser, args)
+
+    archives = find_archives(args.archives)
+    assert archives, f'Found no .abbu dirs in {args.archives}!'
+    args.out.mkdir(parents=True, exist_ok=True)
+    outs = out_dirs(archives, args.out.absolute())
+
+    print(f'START: parsing {len(archives)} archives with {args.procs} processes into {args.out}')
+    t0 = time.time()
+    results = []
+    with ProcessPoolExecutor(args.procs) as pool:
+        fs = [pool.submit(run_one, a, o, args) for a,o in zip(archives,outs)]
+        for f in as_completed(fs):
+            r = f.result()
+            results.append(r)
+            print(f"{len(results)}/{len(fs)} {r['status']:6} {r['seconds']:8.2f}s  {r['archive']}" + (f"  -- {r['error']}" if r['status']!='ok' else ''))
+    results.sort(key=lambda r: archives.index(Path(r['archive'])))
+
+    report = {'seconds': time.time()-t0,
+              'archives': len(results),
+              'ok': sum(r['status']=='ok' for r in results),
+              'failed': sum(r['status']!='ok' for r in results),
+              'results': results}
+    with atomic_open(args.out / 'batch_report.json') as fh:
+        fh.write(json.dumps(report, indent=4))
+    print(f"DONE: {report['ok']}/{report['archives']} archives ok, {report['failed']} failed, in {report['seconds']:.2f}s. Report: {args.out / 'batch_report.json'}")
+    return report['failed'] == 0
+
+
+def find_archives(patterns):
+    '''Returns the .abbu dirs named by the given paths or globs (absolute paths, no dups, in order).'''
+    archives = []
+    for p in patterns:
+        ds = sorted(glob.glob(p, recursive=True)) if glob.has_magic(p) else [p]
+        for d in ds:
+            d = Path(d).absolute()
+            if d.is_dir() and d not in archives:
+                archives.append(d)
+    return archives
+
+
+def out_dirs(archives, out):
+    '''Returns an output dir in out for each archive, named after the archive, eg, 'out/My-Contacts',
+    with a __2, __3, ... suffix if 2 archives have the same name.
+    '''
+    outs = []
+    for a in archives:
+        b = re.sub(r'[^a-zA-Z0-9_.-]','',a.stem.replace(' ','-')) or 'archive'
+        o, n = out / b, 1
+        while o in outs:
+            n += 1
+            o = out / f'{b}__{n}'
+        outs.append(o)
+    return outs
+
+
+def run_one(archive, out, args):
+    '''Parse 1 archive into dir out (see main.run), logging to out/log.txt.
+    Never raises: returns a dict saying how it went, for the batch report.
+    '''
+    t0, c0 = time.time(), time.process_time()
+    r = {'archive': str(archive), 'out': str(out)}
+    try:
+        out.mkdir(parents=True, exist_ok=True)
+        with open(out / 'log.txt', 'w') as log, redirect_stdout(log), redirect_stderr(log):
+            try:
+                main.configure_logging(args.quiet, args.verbose, args.log_format)
+                r.update(main.run(archive, out, args))
+            except BaseException:
+                traceback.print_exc()
+                raise
+        r['status'] = 'ok'
+    except BaseException as e:
+        r['status'] = 'failed'
+        r['error'] = f'{type(e).__name__}: {e}'
+        r['traceback'] = traceback.format_exc()
+    finally:
+        clear_schemas()  # so the archive's dbs aren't left open while the next ones run
+    r['seconds'] = time.time() - t0
+    r['cpu seconds'] = time.process_time() - c0
+    return r
+
+
+if __name__=='__main__':
+    raise SystemExit(0 if batch() else 1)
@@ -0,0 +1,100 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import argparse, json, os, platform, shutil, sqlite3, subprocess, sys, tempfile, time
+from lib import atomic_open, clear_schemas
+from synth import make_abbu
+import main
+
+# Benchmark this program on fake .abbu files (see synth.py) of a few sizes,
+# timing each stage of main.run (per its 'run_report.json'), and save the timings as JSON, to compare against later runs.
+# See README.md for details.
+
+def bench():
+    parser = argparse.ArgumentParser(description='Time each stage of main.py on fake .abbu files of a few sizes. See README.md for details.',
+                                     parents=[main.make_parser(add_help=False)])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], metavar='N',
+        help='# of contacts in each fake .abbu file. (default: 1000 10000 100000)')
+    parser.add_argument('--sources', type=int, default=1,
+        help="Split each fake .abbu file's contacts between the main db and this many dbs in 'Sources/'. (default: 1)")
+    parser.add_argument('--repeat', type=int, default=1, metavar='R',
+        help="Run each size R times, and keep each stage's fastest time. (default: 1)")
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the fake .abbu files. (default: 0)')
+    parser.add_argument('--work-dir', type=Path, default=None,
+        help='Make the fake .abbu files and outputs here, and keep them. (default: a temp dir, deleted when done)')
+    parser.add_argument('--results', type=Path, default=Path('bench_results.json'),
+        help='Save the timings to this JSON file. (default: bench_results.json)')
+    args = parser.parse_args()
+    main.check_args(parser, args)
+
+    work = args.work_dir or Path(tempfile.mkdtemp(prefix='abbu-bench-'))
+    work.mkdir(parents=True, exist_ok=True)
+    results = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'env': env_info(),
+               'args': {k: str(v) if isinstance(v,Path) else v for k,v in vars(args).items()},
+               'runs': []}
+    try:
+        for n in args.sizes:
+            archive = work / f'in-{n}' / f'Fake-{n}.abbu'
+            t0 = time.perf_counter()
+            if not archive.exists():
+                make_abbu(archive, contacts=n // (args.sources+1), sources=args.sources, seed=args.seed)
+            gen = time.perf_counter() - t0
+            print(f'{n} contacts: made {archive} in {gen:.2f}s')
+
+            runs = []
+            for i in range(args.repeat):
+                out = work / f'out-{n}'
+                shutil.rmtree(out, ignore_errors=True)
+                out.mkdir()
+                # Each run gets a fresh process, so no run benefits from what an earlier one cached or imported.
+                with ProcessPoolExecutor(1) as pool:
+                    r = pool.submit(timed_run, archive, out, args).result()
+                runs.append(r)
+                print(f"{n} contacts: run {i+1}/{args.repeat} took {r['seconds']:.2f}s: " +
+                      ', '.join(f'{s} {t:.2f}s' for s,t in r['stages'].items()))
+            results['runs'].append({'contacts': n,
+                                    'generate seconds': gen,
+                                    'seconds': min(r['seconds'] for r in runs),
+                                    'cpu seconds': min(r['cpu seconds'] for r in runs),
+                                    'peak rss bytes': min(r['peak rss bytes'] for r in runs),
+                                    'stages': {s: min(r['stages'][s] for r in runs) for s in runs[0]['stages']},
+                                    'counts': runs[0]['counts']})
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with atomic_open(args.results) as fh:
+        fh.write(json.dumps(results, indent=4))
+    print(f'Saved results to {args.results}')
+
+
+def timed_run(archive, out, args):
+    '''Run main.run on archive into dir out (logging to out/log.txt), and return the main numbers from its run report.'''
+    with open(out / 'log.txt', 'w') as log, redirect_stdout(log):
+        main.configure_logging(args.quiet, args.verbose, args.log_format)
+        try:
+            main.run(archive, out, args)
+        finally:
+            clear_schemas()
+    with open(out / 'run_report.json') as fh:
+        r = json.load(fh)
+    # Each stage's seconds, by name. (A stage name only appears once per run.)
+    r['stages'] = {s['stage']: s['seconds'] for s in r['stages']}
+    return r
+
+def env_info():
+    '''What the timings depend on, besides the code.'''
+    try:
+        commit = subprocess.run(['git','rev-parse','HEAD'], capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'python': sys.version.split()[0],
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+if __name__=='__main__':
+    bench()
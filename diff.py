@@ -0,0 +1,123 @@
+from pathlib import Path
+import argparse, json, tempfile
+from contextlib import nullcontext
+from lib import iter_exported, diff_contact, fingerprint, atomic_open, log, LOG_FORMATS
+import main
+
+# Compare 2 versions of an address book, eg, last week's and this week's backup, and write what changed
+# (added, removed and modified contacts, with each modified contact's changed fields) as a JSON Lines changeset.
+# See README.md for details.
+
+def diff():
+    parser = argparse.ArgumentParser(description='Write what changed between 2 versions of an address book, by UID. See README.md for details.')
+    parser.add_argument('old', type=Path,
+        help="The old version: a 'contacts.json' or 'contacts.jsonl' file, an output dir with one of those, or a .abbu dir.")
+    parser.add_argument('new', type=Path, help='The new version, likewise.')
+    parser.add_argument('--out', type=Path, default=Path('changeset.jsonl'),
+        help='Write the changeset (1 json object per line) to this file. (default: changeset.jsonl)')
+    parser.add_argument('--ignore', nargs='*', default=[], metavar='KEY',
+        help="Don't count changes to these keys, eg, 'modified' or 'sources'.")
+    parser.add_argument('--quiet', '-q', action='store_true', help='Only log warnings and errors.')
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default='text',
+        help="Log plain text, or 1 json object per line. (default: text)")
+    args = parser.parse_args()
+    main.configure_logging(quiet=args.quiet, log_format=args.log_format)
+
+    n = diff_contacts(args.old, args.new, args.out, args.ignore)
+    log.info('%d added, %d removed, %d modified, %d unchanged. Changeset: %s', n['added'], n['removed'], n['modified'], n['unchanged'], args.out)
+    return n['added'] + n['removed'] + n['modified'] == 0
+
+
+def diff_contacts(old : Path, new : Path, out : Path, ignore=()):
+    '''Write the changes from address book old to new (see iter_contacts_in) to JSON Lines file out, matching contacts by UID:
+
+        {"op": "add", "uid": ..., "contact": {...}}
+        {"op": "remove", "uid": ..., "contact": {...}}
+        {"op": "modify", "uid": ..., "changes": {"phone": {"added": [...], "removed": [...]}, "last": {"old": ..., "new": ...}, ...}}
+
+    (see lib.diff_contact): the adds in new's order, then the removes and modifies in old's order.
+
+    Takes time linear in the # of contacts, and doesn't hold either address book in memory:
+    1. Read old, keeping just a fingerprint of each contact (see lib.fingerprint).
+    2. Read new: write each contact whose UID isn't in old as added, and keep those whose fingerprints differ.
+    3. Read old again: diff each of those against its old version, and write the contacts that weren't in new as removed.
+    So it only holds 1 fingerprint per contact, plus the contacts that changed.
+    If old is a .abbu dir, step 1 saves its contacts to a temp file, so step 3 doesn't parse it again.
+    If just one of old & new is a .abbu dir, images ('ims') are ignored.
+    Returns the counts, eg, {'added': 2, 'removed': 1, 'modified': 5, 'unchanged': 42}.
+    '''
+    ignore = set(ignore)
+    if is_export(old) != is_export(new) and 'ims' not in ignore:
+        log.info("Ignoring images ('ims'), since contacts read from a .abbu dir don't have them.")
+        ignore.add('ims')
+    n = {'added': 0, 'removed': 0, 'modified': 0, 'unchanged': 0}
+    with atomic_open(out) as fh, tempfile.TemporaryDirectory(prefix='abbu-diff-') as tmp:
+        def write(x):
+            fh.write(json.dumps(x) + '\n')
+
+        log.info('START: diff %s -> %s', old, new)
+        spill = None
+        if not is_export(old):
+            spill = Path(tmp) / 'old.jsonl'
+        fps = {}
+        with open(spill,'w') if spill else nullcontext() as sp:
+            for c in iter_contacts_in(old):
+                if c['uid'] in fps:
+                    log.warning('Warning: UID %s is in %s more than once; using the last one.', c['uid'], old)
+                fps[c['uid']] = fingerprint(c, ignore)
+                if spill:
+                    sp.write(json.dumps(c) + '\n')
+        log.info('Read %d contacts from %s.', len(fps), old)
+
+        changed, seen = {}, set()
+        for c in iter_contacts_in(new):
+            u = c['uid']
+            if u in seen:
+                log.warning('Warning: UID %s is in %s more than once; skipping the later one.', u, new)
+                continue
+            seen.add(u)
+            fp = fps.pop(u, None)
+            if fp is None:
+                write({'op': 'add', 'uid': u, 'contact': c})
+                n['added'] += 1
+            elif fp != fingerprint(c, ignore):
+                changed[u] = c
+            else:
+                n['unchanged'] += 1
+        log.info('Read %d contacts from %s.', len(seen), new)
+
+        for c in iter_contacts_in(spill or old):
+            u = c['uid']
+            if u in changed:
+                write({'op': 'modify', 'uid': u, 'changes': diff_contact(c, changed.pop(u), ignore)})
+                n['modified'] += 1
+            elif u in fps:
+                del fps[u]
+                write({'op': 'remove', 'uid': u, 'contact': c})
+                n['removed'] += 1
+    return n
+
+
+def is_export(p : Path):
+    '''True if p is an exported json file, or an output dir with one, rather than a .abbu dir.'''
+    return p.is_file() or (p / 'contacts.jsonl').is_file() or (p / 'contacts.json').is_file()
+
+def iter_contacts_in(p : Path):
+    '''Generator: yields the contacts (as exported dicts) in p, 1 at a time: a 'contacts.json' or 'contacts.jsonl' file (see lib.iter_exported),
+    an output dir with one of those, or a .abbu dir, which is parsed from its dbs (see main.iter_all_contacts; no images).
+    Images are compared by what they are ('base name', 'image type', 'info'), not where they were copied from & to.
+    '''
+    if is_export(p):
+        f = p if p.is_file() else p / 'contacts.jsonl' if (p / 'contacts.jsonl').is_file() else p / 'contacts.json'
+        for c in iter_exported(f):
+            if 'ims' in c:
+                c['ims'] = [{k: v for k,v in i.items() if k not in ('path','dst')} for i in c['ims']]
+            yield c
+    else:
+        assert (p / 'AddressBook-v22.abcddb').is_file(), f"Expected {p} to be a contacts.json(l) file, an output dir with one, or a .abbu dir!"
+        for c in main.iter_all_contacts(p):
+            yield json.loads(json.dumps(c.as_dict()))  # Same types as an export's, eg, lists, not tuples.
+
+
+if __name__=='__main__':
+    raise SystemExit(0 if diff() else 1)
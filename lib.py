@@ -1,55 +1,268 @@
-from subprocess import run
-import sqlite3
-from pprint import pprint as pp
-from more_itertools import bucket
-from collections import OrderedDict
+import sqlite3, struct
+from pprint import pformat
+from more_itertools import bucket, peekable
+from collections import Counter, OrderedDict
 from json import JSONEncoder
 import datetime
-from copy import deepcopy
 from pathlib import Path, PosixPath
-import json
+import cProfile, errno, hashlib, json, logging, mmap, os, re, resource, shutil, sys, tempfile, threading, time, tracemalloc, unicodedata
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache, partial
+import io
+
+##################################################
+# Logging
+##################################################
+
+# All of this program's messages go through this logger (see setup_logging).
+# Format them lazily, eg, log.info('Parsed %d people.', n), and wrap big things in Pretty,
+# so nothing is formatted unless it's actually logged.
+log = logging.getLogger('abbu')
+
+class StdoutHandler(logging.StreamHandler):
+    '''Log to whatever sys.stdout is when a message is logged, not when the handler was made,
+    so redirect_stdout catches log messages too (eg, in ppmap and batch.py).
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+class JsonFormatter(logging.Formatter):
+    '''Format each log message as 1 line of json, eg, {"time": "...", "level": "INFO", "message": "..."}.'''
+    def format(self, record):
+        d = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(),
+             'level': record.levelname,
+             'message': record.getMessage()}
+        if record.exc_info:
+            d['exception'] = self.formatException(record.exc_info)
+        return json.dumps(d, cls=DateTimeEncoder)
+
+class Pretty:
+    '''Wrap x to log it pretty-printed, eg, log.debug('Example:\\n%s', Pretty(x)).
+    The pformat only happens if the message is actually logged.
+    '''
+    __slots__ = ['x']
+    def __init__(self, x):
+        self.x = x
+
+    def __str__(self):
+        return pformat(self.x, indent=4)
+
+LOG_FORMATS = ['text', 'json']
+log_config = (logging.INFO, 'text')
+
+def setup_logging(level=logging.INFO, fmt='text'):
+    '''Send the log messages at or above level to stdout, either as plain text (just the message, like print)
+    or, if fmt is 'json', as 1 json object per line (see JsonFormatter).
+    '''
+    global log_config
+    log_config = (level, fmt)
+    for h in list(log.handlers):
+        log.removeHandler(h)
+    h = StdoutHandler()
+    h.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter('%(message)s'))
+    log.addHandler(h)
+    log.setLevel(level)
+    log.propagate = False
+
+setup_logging() # until a script sets it up from its command-line options
+
 
 ##################################################
 # Basic funcs
 ##################################################
 
 def get_file_info(f):
-    return run(['file','--brief',f],capture_output=True,check=True,text=True).stdout
+    '''Describe file f, like the `file --brief` command (see sniff).'''
+    return sniff(f)[0]
+
+def sniff(f):
+    '''Identify file f from its first few bytes, in-process (see sniff_header).'''
+    with open(f,'rb') as fh:
+        return sniff_header(fh.read(100))
+
+def sniff_header(h):
+    '''Identify a file from its first 100 or so bytes ("magic bytes"), like the `file` command does,
+    but without spawning a `file` process per file.
+    Only knows the formats found in .abbu archives: JPEG, PNG, TIFF, GIF and HEIC images, and SQLite dbs.
+    Returns (info, image type), eg,
+
+        ('PNG image data, 320 x 320, 8-bit/color RGBA, non-interlaced\n', 'png')
+        ('SQLite 3.x database, last written using SQLite version 3040001\n', None)
+
+    where info is a shorter version of what `file --brief` says, and image type is what the old
+    stdlib imghdr.what() said (plus 'heic'), or None if it's not an image.
+    If h is too short for the details (a truncated file), info is just the format, eg, 'PNG image data\n'.
+    '''
+    if h[:3] == b'\xff\xd8\xff':
+        if h[6:10] == b'JFIF' and len(h) >= 13:
+            return f'JPEG image data, JFIF standard {h[11]}.{h[12]:02d}\n', 'jpeg'
+        if h[6:10] == b'Exif':
+            return 'JPEG image data, Exif standard\n', 'jpeg'
+        return 'JPEG image data\n', 'jpeg'
+    if h[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(h) < 29:
+            return 'PNG image data\n', 'png'
+        w, ht, depth, color, interlace = struct.unpack('>IIBB2xB', h[16:29])
+        color = {0: f'{depth}-bit grayscale', 2: f'{depth}-bit/color RGB', 3: f'{depth}-bit colormap', 4: f'{depth}-bit gray+alpha', 6: f'{depth}-bit/color RGBA'}.get(color, f'{depth}-bit')
+        return f"PNG image data, {w} x {ht}, {color}, {'interlaced' if interlace else 'non-interlaced'}\n", 'png'
+    if h[:6] in (b'GIF87a', b'GIF89a'):
+        if len(h) < 10:
+            return f'GIF image data, version {h[3:6].decode()}\n', 'gif'
+        w, ht = struct.unpack('<HH', h[6:10])
+        return f'GIF image data, version {h[3:6].decode()}, {w} x {ht}\n', 'gif'
+    if h[:4] in (b'MM\x00*', b'II*\x00'):
+        return f"TIFF image data, {'big' if h[:2]==b'MM' else 'little'}-endian\n", 'tiff'
+    if h[4:8] == b'ftyp' and h[8:12] in (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1'):
+        return 'ISO Media, HEIF Image\n', 'heic'
+    if h[:16] == b'SQLite format 3\x00':
+        if len(h) < 100:
+            return 'SQLite 3.x database\n', None
+        return f"SQLite 3.x database, last written using SQLite version {struct.unpack('>I', h[96:100])[0]}\n", None
+    return ('data\n' if h else 'empty\n'), None
+
+def pmap(f, xs, jobs=1):
+    '''Like list(map(f,xs)), but runs f in 'jobs' threads at once. Good for I/O, like reading or copying files.'''
+    if jobs <= 1:
+        return list(map(f,xs))
+    with ThreadPoolExecutor(jobs) as pool:
+        return list(pool.map(f,xs))
+
+def ppmap(f, xs, jobs=1):
+    '''Like pmap, but runs f in 'jobs' processes at once. Good for CPU-heavy work, like parsing dbs.
+    f must be a top-level func (so it can be pickled). What f prints or logs is printed here, in the order of xs,
+    so the log reads the same as with jobs=1. (The worker processes log like this one does; see setup_logging.)
+    '''
+    xs = list(xs)
+    if jobs <= 1 or len(xs) <= 1:
+        return list(map(f,xs))
+    rs = []
+    with ProcessPoolExecutor(min(jobs,len(xs)), initializer=setup_logging, initargs=log_config) as pool:
+        for r,out in pool.map(partial(call_capturing_stdout,f), xs):
+            print(out, end='')
+            rs.append(r)
+    return rs
+
+def call_capturing_stdout(f, x):
+    '''Returns f(x) and what it printed.'''
+    buf = io.StringIO()
+    with redirect_stdout(buf):
+        r = f(x)
+    return r, buf.getvalue()
 
 def gather(lst, f):
     '''Force more_itertools's 'bucket' to have a more sensible API (like Mathematica's)... without all these iterators ;)'''
     dic = bucket(lst,key=f)
     return [list(dic[k]) for k in dic]
 
-def diff_dicts(d1,d2):
-    ks = set(list(d1.keys()) + list(d2.keys()))
-    for i,k in enumerate(ks):
-        if k in d1 and k not in d2:
-            print(f'Key {i}/{len(ks)}: {k} in d1 and {k} not in d2')
-        elif k not in d1 and k in d2:
-            print(f'Key {i}/{len(ks)}: {k} not in d1 and {k} in d2')
-        elif k not in d1 and k not in d2:
-            print(f'Key {i}/{len(ks)}: WTF, {k} not in BOTH, should never get here!!')
-        elif k in d1 and k in d2:
-            if d1[k] == d2[k]:
-                continue # normal case: both dicts have same val for a key.
-            else:
-                print(f'Key {i}/{len(ks)}: {k} DIFFERS:\n    LEFT: {d1[k]}\n    RIGHT: {d2[k]}')
+def group_by(lst, f):
+    '''Like gather, but returns a dict from each key f(x) to its list of x's (in order), for O(1) lookups by key.'''
+    dic = {}
+    for x in lst:
+        dic.setdefault(f(x),[]).append(x)
+    return dic
+
+def diff_contact(a, b, ignore=()):
+    '''Returns the per-field changes from contact dict a to contact dict b (eg, the same UID in 2 exports; see diff.py):
+    {key: change} for each key (except those in ignore) whose value differs, where change is
+    {'added': [...], 'removed': [...]} for lists, as multisets (ignoring order, but counting repeats), like {'phone': {'added': [['Mobile', '123-123-1234']], 'removed': []}},
+    and {'old': x, 'new': y} for other values, without 'old' if the key is new, or 'new' if it's gone.
+    '''
+    changes = {}
+    for k in dict.fromkeys([*a, *b]):
+        if k in ignore:
+            continue
+        x, y = a.get(k), b.get(k)
+        if x == y:
+            continue
+        if type(x) == list or type(y) == list:
+            xs, ys = Counter(map(canonical, x or [])), Counter(map(canonical, y or []))
+            added, removed = extra(y, ys - xs), extra(x, xs - ys)
+            if added or removed:
+                changes[k] = {'added': added, 'removed': removed}
         else:
-            raise ValueError('Already covered all cases; should never get here.')
+            changes[k] = {**({'old': x} if k in a else {}), **({'new': y} if k in b else {})}
+    return changes
+
+def extra(xs, counts):
+    '''The elements of list xs that Counter counts has (by canonical form), as many times as it counts them, in xs' order.'''
+    out = []
+    for e in xs or []:
+        h = canonical(e)
+        if counts[h] > 0:
+            counts[h] -= 1
+            out.append(e)
+    return out
+
+def canonical(x):
+    '''A json string that's the same for equal values, eg, for comparing or hashing them (tuples and lists are the same).'''
+    return json.dumps(x, sort_keys=True, separators=(',',':'), cls=DateTimeEncoder)
+
+def fingerprint(c, ignore=()):
+    '''A 16-byte hash of contact dict c (except the keys in ignore) that ignores the order of its keys and of its lists' elements,
+    so it only changes when diff_contact would find a change.
+    '''
+    x = {k: sorted(map(canonical,v)) if type(v) == list else v for k,v in c.items() if k not in ignore}
+    return hashlib.blake2b(canonical(x).encode(), digest_size=16).digest()
 
 
 ##################################################
 # Funcs for DB stuff
 ##################################################
 
+class Schema:
+    '''A read-only connection to a sqlite db, plus its table & column names, looked up once and cached.
+    Get one with schema(db), so that all the funcs below share 1 connection per db.
+    '''
+    def __init__(self, db):
+        self.db = Path(db)
+        # mode=ro: never modify (or create) the archive's db.
+        # check_same_thread=False: sqlite3 connections are safe to share between threads; we only read.
+        self.con = sqlite3.connect(f'{self.db.absolute().as_uri()}?mode=ro', uri=True, check_same_thread=False)
+        self.tables = [r[0] for r in self.con.execute("SELECT name FROM sqlite_master WHERE type='table';")]
+        self.columns = {}  # table name -> its column names, filled in as needed by column_names()
+
+_schemas = {}  # resolved path -> (mtime, Schema)
+_old_schemas = []  # ones replaced since their file changed, which another thread may still be using, until clear_schemas
+_schemas_lock = threading.Lock()  # pipeline threads look up schemas at the same time
+
+def schema(db):
+    '''Returns the cached Schema for sqlite db (a path), opening it if this is the 1st time.
+    If the file changed since, a new one is opened (the old one is closed by clear_schemas, since it may still be in use).
+    '''
+    if isinstance(db, Schema):
+        return db
+    p = Path(db).resolve()
+    t = p.stat().st_mtime_ns
+    with _schemas_lock:
+        if p in _schemas and _schemas[p][0] != t:
+            _old_schemas.append(_schemas.pop(p)[1])
+        if p not in _schemas:
+            _schemas[p] = (t, Schema(db))
+        return _schemas[p][1]
+
+def clear_schemas():
+    '''Close all the cached Schemas' connections (see schema), eg, when done with an archive.'''
+    with _schemas_lock:
+        for s in [s for _,s in _schemas.values()] + _old_schemas:
+            s.con.close()
+        _schemas.clear()
+        _old_schemas.clear()
+
 def table_names(db):
     '''Returns the names of the tables in the given sqlite db.'''
-    return [r[0] for r in sqlite3.connect(db).cursor().execute("SELECT name FROM sqlite_master WHERE type='table';").fetchall()]
+    return schema(db).tables
 
 def column_names(t,db):
     '''Returns the (unqualified) column names of table t in sqlite database db.'''
-    return [ r[1] for r in sqlite3.connect(db).cursor().execute(f"PRAGMA table_info('{t}')").fetchall() ]
+    s = schema(db)
+    if t not in s.columns:
+        s.columns[t] = [ r[1] for r in s.con.execute(f"PRAGMA table_info('{t}')") ]
+    return s.columns[t]
 
 def num_rows(t,db):
     '''Gives the number of rows in table t of sqlite db.'''
@@ -57,7 +270,7 @@ def num_rows(t,db):
     # >>> x.fetchall()
     # [(90,)]        
     assert t in table_names(db)
-    return sqlite3.connect(db).cursor().execute(f"SELECT COUNT(1) FROM {t}").fetchall()[0][0]
+    return schema(db).con.execute(f"SELECT COUNT(1) FROM {t}").fetchone()[0]
 
 def table_has_columnQ(t,c,db):
     return c in column_names(t,db)
@@ -75,15 +288,18 @@ def should_join_tableQ(t,db):
     if t in ['ZABCDCUSTOMPROPERTYVALUE']: return False
     return any(table_has_columnQ(t,c,db) for c in ['ZOWNER','ZCONTACT'])
 
-def join_condition(t,db):
-    '''Returns a SQL snippet for left-joining the given table to the main ZABCDRECORD table,
+def join_predicate(t,db):
+    '''Returns a SQL snippet matching rows of the given table to rows of the main ZABCDRECORD table,
     based on the presence of columns ZOWNER or ZCONTACT in the given table.
     '''
-    predicate = ' OR '.join(f'({t}.{c} = ZABCDRECORD.Z_PK)' for c in ['ZOWNER','ZCONTACT'] if table_has_columnQ(t,c,db))
-    return f'LEFT JOIN {t} ON ({predicate})'
+    return ' OR '.join(f'({t}.{c} = ZABCDRECORD.Z_PK)' for c in ['ZOWNER','ZCONTACT'] if table_has_columnQ(t,c,db))
+
+def join_condition(t,db):
+    '''Returns a SQL snippet for left-joining the given table to the main ZABCDRECORD table.'''
+    return f'LEFT JOIN {t} ON ({join_predicate(t,db)})'
 
-def select_subclause(t,db):
-    '''Returns a SQL snippet for selecting the given table's relevant columns, eg, 
+def select_subclause(t,db,cols=None):
+    '''Returns a SQL snippet for selecting the given table's relevant columns (or just cols), eg, 
 
     TAB.COL1 as 'TAB.COL1'
     TAB.COL2 as 'TAB.COL2'
@@ -95,7 +311,66 @@ def select_subclause(t,db):
     2 columns both named 'foo' -- bad. So force uniqueness by specifying table_name.column_name .
     '''
 
-    return '\n   , '.join( f"{t}.{c} as '{t}.{c}'" for c in column_names(t,db) )
+    return '\n   , '.join( f"{t}.{c} as '{t}.{c}'" for c in (column_names(t,db) if cols is None else cols) )
+
+def iter_blobs(t,c,db,key='ZUNIQUEID'):
+    '''Generator: yields (rowid, value of column key, # bytes) for each row of table t whose column c holds a blob,
+    without reading the blobs themselves (sqlite's length() and typeof() only look at a value's header).
+    '''
+    yield from schema(db).con.execute(f"SELECT rowid, {key}, length({c}) FROM {t} WHERE typeof({c}) = 'blob' ORDER BY rowid")
+
+def read_blob(t,c,rowid,db,n=-1):
+    '''Returns the 1st n bytes (or all) of the blob in column c of row rowid of table t.'''
+    with schema(db).con.blobopen(t, c, rowid, readonly=True) as b:
+        return b.read(n)
+
+def copy_blob(t,c,rowid,db,dst,offset=0,chunk_size=1<<16):
+    '''Write the blob in column c of row rowid of table t, minus its 1st offset bytes, to file dst.
+    Uses sqlite's incremental blob I/O (Connection.blobopen), chunk_size bytes at a time,
+    so the blob is never all in memory. Returns the # of bytes written.
+    '''
+    n = 0
+    with schema(db).con.blobopen(t, c, rowid, readonly=True) as b, atomic_open(dst,'wb') as fh:
+        b.seek(offset)
+        while x := b.read(chunk_size):
+            fh.write(x)
+            n += len(x)
+    return n
+
+def plan_contact_query(db, fields=None):
+    '''Works out the least that iter_contact_rows has to select from db, from the declarative field map 'fields':
+    {'TABLE.COLUMN': key, ...} gives the key that column gets in a contact row, or None to drop it,
+    and {'TABLE.*': None} drops a whole table. Only looks at db's schema, never at its rows.
+
+    Returns {table: [(column, key), ...]}, the main table ZABCDRECORD first, then each table to join to it
+    (see should_join_tableQ). A table with no columns left isn't joined at all.
+
+    Columns that the map doesn't mention are kept, as 'TABLE.COLUMN'. So are tables that the map doesn't mention at all
+    (eg, ones new in a newer macOS), with a warning saying what's in them, so they can be added to the map.
+    If fields is None, keep every column of every table that can be joined, as 'TABLE.COLUMN'.
+    '''
+    main_table = 'ZABCDRECORD'
+    fields = fields or {}
+    known = {k.split('.',1)[0] for k in fields}
+    plan, unmapped = {}, []
+    for t in [main_table] + [t for t in table_names(db) if should_join_tableQ(t,db)]:
+        if fields and t not in known and t != main_table:
+            log.warning("Warning: %s has a table %s that isn't in the field map, so keeping its columns as is: %s", db, t, ', '.join(column_names(t,db)))
+        if f'{t}.*' in fields and fields[f'{t}.*'] is None:
+            continue
+        cs = []
+        for c in column_names(t,db):
+            k = f'{t}.{c}'
+            if k not in fields:
+                unmapped.append(k)
+                cs.append((c,k))
+            elif fields[k] is not None:
+                cs.append((c,fields[k]))
+        if cs or t == main_table:
+            plan[t] = cs
+    if fields and unmapped:
+        log.info("%s has %d columns that aren't in the field map, so keeping them as is: %s", db, len(unmapped), ', '.join(unmapped))
+    return plan
 
 
 
@@ -104,13 +379,14 @@ def select_subclause(t,db):
 # Main db-to-dicts method.
 #########################################
 
-def parse_abcddb(db : Path):
+def parse_abcddb(db : Path, fields=None, convert=None):
     '''Return a list of Contacts as dicts from a Mac Address Book sqlite db like 'My Contacts.abbu/AddressBook-v22.abcddb'.
         NOTE: The UID column ('ZABCDRECORD.ZUNIQUEID') will be non-unique in the list of returned dicts
-        if a contact had multiple types of phone / email / url / address values. There's probably some way
-        to GROUP BY in the sql, but I'd rather resolve it in python.
+        if a contact had multiple types of phone / email / url / address values (see contact_rows).
+        I'd rather resolve that in python.
+        See iter_contact_rows for fields and convert.
     '''
-    print(f'START: parse abcddb file {db} .')
+    log.info('START: parse abcddb file %s .', db)
 
     assert str(db).endswith('.abcddb')
     assert 'SQLite 3.x database' in get_file_info(db)
@@ -119,29 +395,30 @@ def parse_abcddb(db : Path):
     # Print DB Info
     #################################
 
-    print(f'In db {db}, # tables = {len(table_names(db))}')
+    log.info('In db %s, # tables = %d', db, len(table_names(db)))
 
-    t_infos = [{ 'name': t, 
-                 'num cols': len(column_names(t,db)),
-                 'num rows': num_rows(t,db),
-                 'should join?': should_join_tableQ(t,db)
-               }
-                 for t in table_names(db)
-              ]
+    if log.isEnabledFor(logging.DEBUG): # Counting every table's rows takes a while, so only do it if it's logged.
+        t_infos = [{ 'name': t, 
+                     'num cols': len(column_names(t,db)),
+                     'num rows': num_rows(t,db),
+                     'should join?': should_join_tableQ(t,db)
+                   }
+                     for t in table_names(db)
+                  ]
 
-    x = [t for t in t_infos if t['should join?']]
-    print(f"{len(x)} tables should join:")
-    for e in x:
-        print(f"{e['name']} -- {e['num cols']} cols -- {e['num rows']} rows")
+        x = [t for t in t_infos if t['should join?']]
+        log.debug('%d tables should join:', len(x))
+        for e in x:
+            log.debug('%s -- %d cols -- %d rows', e['name'], e['num cols'], e['num rows'])
 
-    print('\n\n------------------------------\n\n')
+        log.debug('\n\n------------------------------\n\n')
 
-    x = [t for t in t_infos if not t['should join?']]
-    print(f"{len(x)} tables NOT should join:")
-    for e in x:
-        print(f"{e['name']} -- {e['num cols']} cols -- {e['num rows']} rows")
+        x = [t for t in t_infos if not t['should join?']]
+        log.debug('%d tables NOT should join:', len(x))
+        for e in x:
+            log.debug('%s -- %d cols -- %d rows', e['name'], e['num cols'], e['num rows'])
 
-    print('\n\n------------------------------\n\n')
+        log.debug('\n\n------------------------------\n\n')
 
 
 
@@ -149,66 +426,116 @@ def parse_abcddb(db : Path):
     # Query.
     ##############################
 
-    main_table = 'ZABCDRECORD'
-    joined_tables = [t for t in table_names(db) if should_join_tableQ(t,db)]
-    all_tables = [main_table] + joined_tables
-    select_clause = '\n , '.join(select_subclause(t,db) for t in all_tables)
-    join_clause = main_table + '\n' + '\n'.join(join_condition(t,db) for t in joined_tables)
-    q = f'''SELECT
-    {select_clause}
-    FROM
-    {join_clause}
-    '''
-    print('~~~~~~~ QUERY: ~~~~~~~~~')
-    print(q)
-    print('~~~~~~~ END QUERY ~~~~~~~~~')
-    print('Querying...')
-    x = sqlite3.connect(db).cursor().execute(q)
-    print('Done w/ query.')
-    rs = x.fetchall()
-    cs = [r[0] for r in x.description]
-    print(f'Fetched {len(rs)} rows, {len(cs)} cols.')
-    print("Convert to dicts, remove 'null' data...")
-    ds = [dict((k,v) for k,v in zip(cs,r) if v) for r in rs]  # "if v" to omit keys that are None, 0, '', [], ...
-    print(f'Done parsing {db}, returning {len(ds)} Contact dicts.')
+    ds = contact_rows(db, fields, convert)
+    log.info('Done parsing %s, returning %d Contact dicts.', db, len(ds))
     if len(ds)>0:
-        print('Example dict:')
-        pp(ds[-1])
+        log.debug('Example dict:\n%s', Pretty(ds[-1]))
     return ds
 
 
+def contact_rows(db : Path, fields=None, convert=None):
+    '''Return all the dicts from iter_contact_rows as one list.'''
+    ds = [d for pk,rs in iter_contact_rows(db, fields=fields, convert=convert) for d in rs]
+    log.info('Fetched %d rows.', len(ds))
+    return ds
+
+
+def iter_contact_rows(db : Path, batch_size=1000, pks=None, fields=None, convert=None):
+    '''Generator: query the main ZABCDRECORD table and each table that joins to it (see should_join_tableQ) separately,
+    then stitch the results together per record, keyed on ZABCDRECORD.Z_PK.
+    Yields (Z_PK, [dict, ...]) for one record at a time, in Z_PK order.
+
+    This used to be one big query LEFT JOINing every table onto ZABCDRECORD, but that returns the
+    cartesian product of each contact's child rows: a contact with 4 phones, 5 emails, 3 urls and 2 addresses
+    came back as 4*5*3*2 = 120 rows. Instead, we yield 1 + (# child rows beyond each table's first) dicts per record:
+
+    - The first dict is the record's columns plus the first row from each joined table (same as the first row of the big join).
+    - Then one more dict per remaining child row: the record's columns plus that child row.
 
-def merge_dicts(dlist : list):
-    '''Smoosh the given dicts into a single dict: Take the first dict,
-    then add new key-value pairs in subsequent dicts.
-    For colliding keys whose values are lists, append new values.
-    Raise error for colliding keys whose values are NOT lists.
+    Merging these by UID (see clean_contacts) gives the same contact as merging the big join did.
+    Keys look like 'TABLE.COLUMN' (see select_subclause), and null-ish values are omitted.
+
+    Each table gets its own cursor, ordered by ZABCDRECORD.Z_PK and read batch_size rows at a time (fetchmany),
+    and the cursors are walked in step, so only about 1 record's rows are in memory at once.
+
+    If pks is given, only query the records with those Z_PKs.
+
+    If fields is given, it's a field map saying which columns to select and what keys to give them (see plan_contact_query).
+    Dropped columns aren't even selected, and a joined table with no columns left isn't queried at all.
+    Each cursor's keys are worked out once, from the plan, so turning a row into a dict is just a zip.
+
+    If convert is given, it's a dict from key to a func to apply to that key's (non-null) values,
+    eg, {'modified': core_data_date}, applied as each batch of rows is fetched.
     '''
-    if len(dlist)==1:
-        return dlist[0]
-    else:
-        z = deepcopy(dlist[0])
-        for y in dlist[1:]:
-            for k,v in y.items():
-                if k not in z:
-                    z[k] = v
-                else: # key collision
-                    if z[k] == v:
-                        continue # ok, already have it
-                    else:
-                        # vals differ. if vals are lists, concat them. else, complain.
-                        if type(z[k]) == list and type(v) == list:
-                            z[k].extend(v)
-                        else:
-                            raise ValueError(f"Uh oh: different vals and non-lists: key '{k}', z[k] = '{z[k]}'', y[k] = '{y[k]}'")
-    return z
+    con = schema(db).con
+    (main_table, main_cols), *joined = plan_contact_query(db, fields).items()
+
+    where, params = '', ()
+    if pks is not None:
+        where, params = f'WHERE {main_table}.Z_PK IN (SELECT value FROM json_each(?))', (json.dumps(sorted(pks)),)
+
+    def fetch(q, cols):
+        x = con.cursor().execute(q, params)
+        cs = [k for c,k in cols]
+        fs = [convert.get(k) for k in cs] if convert else []
+        while rs := x.fetchmany(batch_size):
+            if not any(fs):
+                for r in rs:
+                    yield r[0], dict((k,v) for k,v in zip(cs,r[1:]) if v)  # "if v" to omit keys that are None, 0, '', [], ...
+                continue
+            for r in rs:
+                yield r[0], dict((k,f(v) if f else v) for k,f,v in zip(cs,fs,r[1:]) if v)
+
+    def select(t, cols):
+        return select_subclause(t, db, [c for c,k in cols])
+
+    records = fetch(f"SELECT {main_table}.Z_PK, {select(main_table,main_cols)} FROM {main_table} {where} ORDER BY {main_table}.Z_PK", main_cols)
+    children = [peekable(fetch(f"SELECT {main_table}.Z_PK, {select(t,cols)} FROM {main_table} JOIN {t} ON ({join_predicate(t,db)}) {where} ORDER BY {main_table}.Z_PK, {t}.rowid", cols))
+                for t,cols in joined]
+
+    for pk,r in records:
+        rss = []
+        for it in children:
+            rs = []
+            while it and it.peek()[0] == pk:
+                rs.append(next(it)[1])
+            if rs:
+                rss.append(rs)
+        first = dict(r)
+        for rs in rss:
+            first.update(rs[0])
+        yield pk, [first] + [{**r, **d} for rs in rss for d in rs[1:]]
+
+
+def record_fingerprints(db : Path):
+    '''Returns [(Z_PK, UID, fingerprint), ...] for each person record ('...:ABPerson') in the given .abcddb, in Z_PK order.
+    The fingerprint is a string that changes whenever the record is modified: its ZMODIFICATIONDATE and Z_OPT
+    (Core Data's per-row version counter).
+    '''
+    cs = [c for c in ['ZMODIFICATIONDATE','Z_OPT'] if table_has_columnQ('ZABCDRECORD',c,db)]
+    q = f"SELECT Z_PK, ZUNIQUEID, {', '.join(['NULL']+cs)} FROM ZABCDRECORD WHERE ZUNIQUEID LIKE '%:ABPerson' ORDER BY Z_PK"
+    return [(r[0], r[1], repr(r[3:])) for r in schema(db).con.execute(q)]
+
+def record_uids(db : Path):
+    '''Returns the UIDs of all records (contacts, groups, ...) in the given .abcddb, like 'C13384AC-D081-4190-B5CB-DAEEE889A64D:ABPerson'.'''
+    return [r[0] for r in schema(db).con.execute("SELECT ZUNIQUEID FROM ZABCDRECORD") if r[0]]
+
+
+
+def hashable(x):
+    '''Returns a hashable version of x, which may contain dicts and lists, eg for putting it in a set.'''
+    if isinstance(x, dict):
+        return tuple(sorted((k,hashable(v)) for k,v in x.items()))
+    if isinstance(x, (list,tuple)):
+        return tuple(hashable(v) for v in x)
+    return x
 
 
 def duplicate_freeQ(lst, f):
     dup_groups = list(filter(lambda g: len(g)!=1, gather(lst,f)))
     if len(dup_groups)>0:
-        print(f"WARNING: {sum(len(g) for g in dup_groups)}/{len(lst)} elems are duplicates; {len(dup_groups)} subsets:")
-        pp(dup_groups)
+        log.warning('WARNING: %d/%d elems are duplicates; %d subsets.', sum(len(g) for g in dup_groups), len(lst), len(dup_groups))
+        log.debug('The duplicates:\n%s', Pretty(dup_groups))
         return False
     else:
         return True
@@ -218,6 +545,35 @@ def dict_subsetQ(x,y):
     return all(k in y and v==y[k] for k,v in x.items())
 
 
+# Core Data (so the .abcddb) stores a date as a float: seconds since its "reference date", 2001-01-01 UTC.
+CORE_DATA_EPOCH = datetime.datetime(2001,1,1,tzinfo=datetime.timezone.utc)
+
+@lru_cache(maxsize=1<<16)
+def core_data_date(x):
+    '''Returns Core Data date x as an ISO timestamp, eg, 700000000.0 -> '2023-03-08T20:26:40+00:00'.
+    Cached, since many records share a date (eg, everything a sync touched at once).
+    Returns x as is if it's out of range.
+    '''
+    try:
+        return (CORE_DATA_EPOCH + datetime.timedelta(seconds=x)).isoformat(timespec='seconds')
+    except (OverflowError, TypeError):
+        return x
+
+def core_data_day(x):
+    '''Returns Core Data date x as an ISO date, eg, 700000000.0 -> '2023-03-08'. (For birthdays.)'''
+    d = core_data_date(x)
+    return d[:10] if type(d) == str else d
+
+def iso_date(s):
+    '''Returns date/time string s (ISO format, eg, '2023-03-08' or '2023-03-08T20:26:40-08:00'; UTC if no time zone)
+    in the same format as core_data_date, so the two compare as strings.
+    '''
+    d = datetime.datetime.fromisoformat(s)
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=datetime.timezone.utc)
+    return d.astimezone(datetime.timezone.utc).isoformat(timespec='seconds')
+
+
 # For exporting: json can't export datetime. extend json.dumps to convert a datetime into isoformat, eg:
 #       x.isoformat()
 #       => '2020-08-29T20:39:13.248940'
@@ -238,11 +594,529 @@ def export(obj,f):
     '''Export list/dict object obj into json file f,
        serializing datetimes into isoformat '2020-08-29T20:39:13.248940'.
     '''
-    print(f'START: Exporting {type(obj)} of len {len(obj)} to file {f}')
+    log.info('START: Exporting %s of len %d to file %s', type(obj), len(obj), f)
+
+    with atomic_open(f) as fh:
+        fh.write(json.dumps(obj,
+            indent=4,
+            cls=DateTimeEncoder
+            ))
+
+    log.info('DONE: Exporting to file %s', f)
+
+
+def export_stream(objs,f,jsonl=False):
+    '''Export the dicts from iterable objs into json file f, one at a time,
+       so the whole json document is never in memory at once.
+       Writes the same bytes as export(list(objs),f).
+       If jsonl, instead write 1 compact json object per line (JSON Lines, eg, 'contacts.jsonl').
+       Returns the number of dicts exported.
+    '''
+    log.info('START: Streaming export to file %s', f)
+
+    n = 0
+    with atomic_open(f) as fh:
+        if not jsonl:
+            fh.write('[')
+        for obj in objs:
+            if jsonl:
+                fh.write(json.dumps(obj, cls=DateTimeEncoder) + '\n')
+            else:
+                # Same as json.dumps(list, indent=4): each element is indented 1 more level.
+                # (json strings can't contain raw newlines, so splitting on them is safe.)
+                fh.write(('\n' if n==0 else ',\n') + '\n'.join('    ' + l for l in json.dumps(obj, indent=4, cls=DateTimeEncoder).split('\n')))
+            n += 1
+        if not jsonl:
+            fh.write('\n]' if n>0 else ']')
+
+    log.info('DONE: Exporting %d objects to file %s', n, f)
+    return n
+
+
+# The search index: the exported contacts in a sqlite db, with tables & indexes for looking them up
+# by name, email or phone (see index_writer, and search.py for querying it).
+INDEX_VERSION = 1
+INDEX_SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE contacts (id INTEGER PRIMARY KEY, uid TEXT NOT NULL, first TEXT, middle TEXT, last TEXT, nickname TEXT,
+                       organization TEXT, note TEXT, created TEXT, modified TEXT, birthday TEXT,
+                       json TEXT NOT NULL);
+CREATE TABLE phones (contact INTEGER NOT NULL REFERENCES contacts(id), label TEXT, value TEXT, digits TEXT, rdigits TEXT);
+CREATE TABLE emails (contact INTEGER NOT NULL REFERENCES contacts(id), label TEXT, value TEXT, normalized TEXT);
+CREATE TABLE urls (contact INTEGER NOT NULL REFERENCES contacts(id), label TEXT, value TEXT);
+CREATE TABLE addresses (contact INTEGER NOT NULL REFERENCES contacts(id), label TEXT,
+                        street TEXT, city TEXT, state TEXT, zip TEXT, country TEXT, country_code TEXT);
+'''
+# Built once all the rows are in, which is faster than keeping them up to date row by row.
+INDEX_INDEXES = '''
+CREATE UNIQUE INDEX contacts_uid ON contacts(uid);
+CREATE INDEX contacts_modified ON contacts(modified);
+CREATE INDEX phones_digits ON phones(digits);
+CREATE INDEX phones_rdigits ON phones(rdigits);
+CREATE INDEX phones_contact ON phones(contact);
+CREATE INDEX emails_normalized ON emails(normalized);
+CREATE INDEX emails_contact ON emails(contact);
+CREATE INDEX urls_contact ON urls(contact);
+CREATE INDEX addresses_contact ON addresses(contact);
+CREATE VIRTUAL TABLE contacts_fts USING fts5(first, middle, last, nickname, organization, note,
+                                             content='contacts', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild');
+'''
+
+def phone_digits(s):
+    '''Just the digits of phone number s, eg, '+1 (123) 123-1234' -> '11231231234'.'''
+    return re.sub(r'\D', '', s)
+
+def normalize_email(s):
+    return s.strip().lower()
+
+
+# Finding contacts that are likely the same person under different UIDs (eg, from 2 accounts in Sources/),
+# without comparing all pairs: only contacts that share a blocking key (an email, a phone number, or a full name) are compared.
+
+def name_tokens(*names):
+    '''The words in names, lowercased and without accents, sorted, eg, ('José', "O'Neil") -> ('jose', 'neil', 'o').'''
+    s = unicodedata.normalize('NFKD', ' '.join(n for n in names if n)).lower()
+    return tuple(sorted(set(re.findall(r'[^\W_]+', ''.join(ch for ch in s if not unicodedata.combining(ch))))))
+
+# Groups of given names that are the same person's, eg, a 'Bob' and a 'Robert' (see same_given_nameQ).
+NICKNAMES = [s.split() for s in str.splitlines('''
+    robert bob bobby rob robbie bert
+    william bill billy will willy liam
+    richard rick ricky rich dick
+    james jim jimmy jamie
+    john jack johnny jon
+    jonathan jon jonny
+    michael mike mikey mick
+    thomas tom tommy
+    joseph joe joey
+    charles charlie chuck chas
+    edward ed eddie ted ned
+    daniel dan danny
+    anthony tony
+    christopher chris kit
+    christine chris chrissy tina
+    david dave davey
+    steven stephen steve
+    alexander alex al sasha
+    alexandra alex sandra sasha
+    samuel sam sammy
+    samantha sam
+    benjamin ben benny
+    nicholas nick nicky
+    matthew matt
+    andrew andy drew
+    timothy tim timmy
+    gregory greg
+    kenneth ken kenny
+    ronald ron ronnie
+    donald don donnie
+    lawrence larry
+    peter pete
+    patrick pat paddy
+    patricia pat patty trish
+    elizabeth liz lizzie beth betty betsy eliza
+    margaret maggie meg peggy
+    katherine catherine kathryn kate katie kathy cathy kat
+    jennifer jen jenny
+    susan sue susie suzy
+    deborah debra deb debbie
+    rebecca becky becca
+    victoria vicky tori
+    jessica jess jessie
+    ''') if s.strip()]
+NICKNAME_GROUPS = {}  # name -> indexes of its groups in NICKNAMES
+for i,g in enumerate(NICKNAMES):
+    for n in g:
+        NICKNAME_GROUPS.setdefault(n, set()).add(i)
+
+def same_given_nameQ(a, b):
+    '''True if given name tokens a and b (see name_tokens) could be the same person's: they share a word,
+    or a word of one is an initial of, or a nickname for (see NICKNAMES), a word of the other.'''
+    def names(x):  # x and the names it's a nickname for, or that are nicknames for it
+        return {x}.union(*(NICKNAMES[i] for i in NICKNAME_GROUPS.get(x, ())))
+    for x in a:
+        for y in b:
+            if len(x) == 1 or len(y) == 1:
+                i, n = sorted((x, y), key=len)
+                if any(m.startswith(i) for m in names(n)):
+                    return True
+            elif names(x) & names(y):
+                return True
+    return False
+
+def duplicate_features(c):
+    '''What find_duplicates compares of contact c (a dict or main.Contact):
+    (uid, name tokens, emails, phones' digits, organization, name, given name tokens).'''
+    names = (c.get('first'), c.get('ZABCDRECORD.ZMIDDLENAME'), c.get('last'))
+    return (c['uid'],
+            name_tokens(*names),
+            frozenset(normalize_email(v) for _,v in c.get('email',[])),
+            frozenset(d for _,v in c.get('phone',[]) for d in [phone_digits(v)] if len(d) >= 7),
+            (c.get('organization') or '').strip().lower() or None,
+            ' '.join(n for n in names if n) or c.get('organization'),
+            name_tokens(c.get('first')))
+
+def blocking_keys(f):
+    '''The keys of duplicate_features f: contacts are only compared if they share one.
+    Phones are keyed by their last 7 digits, so a missing country or area code still matches, and names need at least 2 words.
+    '''
+    uid, name, emails, phones, org, *_ = f
+    return ([('email', e) for e in emails] + [('phone', d[-7:]) for d in phones]
+            + ([('name', ' '.join(name))] if len(name) >= 2 else []))
+
+def duplicate_score(f, g):
+    '''How likely (from 0 to 1) duplicate_features f and g are the same person, and why, eg, (0.95, ['email', 'name']).
+    A shared email or phone is enough (unless the names differ); the same name, even at the same organization, isn't.
+    Names differ if they share no words, or if their given names differ (see same_given_nameQ),
+    eg, a family's shared landline doesn't make Bob Jones and Mary Jones the same person.
+    '''
+    s, why = 0.0, []
+    if f[2] & g[2]:
+        s += 0.6
+        why.append('email')
+    if any(a.endswith(b) or b.endswith(a) for a in f[3] for b in g[3]):
+        s += 0.5
+        why.append('phone')
+    if f[1] and g[1]:
+        if f[6] and g[6] and not same_given_nameQ(f[6], g[6]):
+            s -= 0.3  # Eg, a family's shared landline or email.
+        elif f[1] == g[1]:
+            s += 0.35
+            why.append('name')
+        else:
+            common = len(set(f[1]) & set(g[1]))
+            if common:
+                s += 0.35 * common / len(set(f[1]) | set(g[1]))
+                why.append('similar name')
+            else:
+                s -= 0.3  # Eg, a family's shared landline or email.
+    if f[4] and f[4] == g[4]:
+        s += 0.1
+        why.append('organization')
+    return round(max(0.0, min(s, 1.0)), 2), why
+
+def find_duplicates(fs, threshold=0.5, max_block=100):
+    '''Find the likely duplicates among contacts with duplicate_features fs:
+    1. Group them by blocking key (see blocking_keys). Groups bigger than max_block (eg, a company's main number) are skipped.
+    2. Score each pair in the same group (see duplicate_score).
+    3. Cluster the pairs that score at least threshold (a contact's duplicates' duplicates are its duplicates too).
+    This takes about linear time, since most groups are tiny.
+    Returns a report: {'contacts': #, 'candidate pairs': #, 'skipped blocks': #, 'clusters': [{'uids': [...], 'names': [...], 'pairs': [...]}, ...]},
+    with the biggest clusters first, and each pair like {'uids': [a, b], 'score': 0.9, 'because': ['email', 'name']}.
+    '''
+    fs = list(fs)
+    blocks = {}
+    for i,f in enumerate(fs):
+        for k in blocking_keys(f):
+            blocks.setdefault(k, []).append(i)
+
+    pairs, skipped = set(), 0
+    for k,ix in blocks.items():
+        if len(ix) > max_block:
+            skipped += 1
+            log.debug('Not comparing the %d contacts with %s %r: too many.', len(ix), *k)
+            continue
+        pairs.update((ix[a], ix[b]) for a in range(len(ix)) for b in range(a+1, len(ix)) if ix[a] != ix[b])
+    log.info('Comparing %d pairs of contacts that share an email, phone or name, out of %d contacts.', len(pairs), len(fs))
+
+    # Union-find, so clusters come out whole however their pairs were found.
+    parent = list(range(len(fs)))
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    matches = []
+    for i,j in sorted(pairs):
+        score, why = duplicate_score(fs[i], fs[j])
+        if score >= threshold:
+            matches.append((i, j, score, why))
+            parent[max(root(i), root(j))] = min(root(i), root(j))
+
+    clusters = {}
+    for i,j,score,why in matches:
+        c = clusters.setdefault(root(i), {'members': set(), 'pairs': []})
+        c['members'].update((i,j))
+        c['pairs'].append({'uids': [fs[i][0], fs[j][0]], 'score': score, 'because': why})
+    clusters = sorted(clusters.values(), key=lambda c: (-len(c['members']), min(c['members'])))
+    log.info('Found %d clusters of likely duplicates, with %d contacts.', len(clusters), sum(len(c['members']) for c in clusters))
+    return {'contacts': len(fs), 'candidate pairs': len(pairs), 'skipped blocks': skipped, 'threshold': threshold,
+            'clusters': [{'uids': [fs[i][0] for i in sorted(c['members'])],
+                          'names': [fs[i][5] for i in sorted(c['members'])],
+                          'pairs': c['pairs']} for c in clusters]}
+
+def iter_exported(f, chunk_size=1<<16):
+    '''Generator: yields the dicts in json file f 1 at a time, without reading the whole file into memory:
+    either a json list of them, like export_stream writes ('contacts.json'), or 1 per line ('contacts.jsonl').
+    '''
+    dec = json.JSONDecoder()
+    with open(f, encoding='utf-8') as fh:
+        buf, i, eof = '', 0, False
+        while True:
+            # Skip what's between the dicts: whitespace, the list's brackets and commas.
+            while i < len(buf) and buf[i] in ' \t\r\n[],':
+                i += 1
+            if i == len(buf):
+                if eof:
+                    return
+                buf, i = fh.read(chunk_size), 0
+                eof = not buf
+                continue
+            try:
+                d, j = dec.raw_decode(buf, i)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = fh.read(max(chunk_size, len(buf)))  # The dict goes past the end of buf: read more (at least double it).
+                buf, i, eof = buf[i:] + more, 0, not more
+                continue
+            yield d
+            i = j
+
+@contextmanager
+def index_writer(f):
+    '''Write a search index of contacts to sqlite db file f (see INDEX_SCHEMA): gives a func add(c) to add
+    contact dict c (the exported kind, eg, from Contact.as_dict) and return it, so it can sit in a pipeline, eg,
+
+        with index_writer('out/contacts.db') as add:
+            export_stream(map(add, cs), 'out/contacts.json')
+
+    Like atomic_open, f is only replaced once the 'with' block finishes without error.
+    '''
+    log.info('START: Writing search index to file %s', f)
+    f = Path(f)
+    fd, tmp = tempfile.mkstemp(dir=f.parent, prefix=f'.{f.name}.', suffix='.tmp')
+    os.close(fd)
+    con = sqlite3.connect(tmp)
+    n = 0
+    try:
+        # It's a new file, renamed into place at the end, so no need for a journal or fsyncs.
+        con.execute('PRAGMA journal_mode = OFF')
+        con.execute('PRAGMA synchronous = OFF')
+        con.executescript(INDEX_SCHEMA)
+
+        # Rows to insert, per table, sent to sqlite 1000 contacts at a time.
+        inserts = {'contacts': 'INSERT INTO contacts VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', 'phones': 'INSERT INTO phones VALUES (?,?,?,?,?)',
+                   'emails': 'INSERT INTO emails VALUES (?,?,?,?)', 'urls': 'INSERT INTO urls VALUES (?,?,?)',
+                   'addresses': 'INSERT INTO addresses VALUES (?,?,?,?,?,?,?,?)'}
+        rows = {t: [] for t in inserts}
+
+        def flush():
+            for t,q in inserts.items():
+                con.executemany(q, rows[t])
+                rows[t].clear()
+
+        def add(c):
+            nonlocal n
+            n += 1
+            rows['contacts'].append((n, c['uid'], c.get('first'), c.get('ZABCDRECORD.ZMIDDLENAME'), c.get('last'), c.get('ZABCDRECORD.ZNICKNAME'),
+                                     c.get('organization'), c.get('ZABCDNOTE.ZTEXT'), c.get('created'), c.get('modified'), c.get('birthday'),
+                                     json.dumps(c, cls=DateTimeEncoder)))
+            rows['phones'].extend((n, lab, v, d, d[::-1]) for lab,v in c.get('phone',[]) for d in [phone_digits(v)])
+            rows['emails'].extend((n, lab, v, normalize_email(v)) for lab,v in c.get('email',[]))
+            rows['urls'].extend((n, lab, v) for lab,v in c.get('url',[]))
+            rows['addresses'].extend((n, lab, a.get('street'), a.get('city'), a.get('state'), a.get('zip'), a.get('country'), a.get('country code'))
+                                     for lab,a in c.get('address',[]))
+            if n % 1000 == 0:
+                flush()
+            return c
+
+        with con:
+            yield add
+            flush()
+            con.executescript(INDEX_INDEXES)
+            con.executemany('INSERT INTO meta VALUES (?,?)', [('version', INDEX_VERSION), ('contacts', n)])
+        con.close()
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, f)
+    except BaseException:
+        con.close()
+        os.unlink(tmp)
+        raise
+    log.info('DONE: Indexed %d contacts into file %s', n, f)
+
+
+# The process's umask, read once, at import: reading it means setting it, which would change the perms of files
+# that other threads make meanwhile.
+UMASK = os.umask(0); os.umask(UMASK)
+
+@contextmanager
+def atomic_open(f, mode='w'):
+    '''Like open(f,mode), but writes to a temp file in the same dir, which is renamed to f
+       only once the 'with' block finishes without error. So f is never left half-written.
+    '''
+    f = Path(f)
+    fd, tmp = tempfile.mkstemp(dir=f.parent, prefix=f'.{f.name}.', suffix='.tmp')
+    try:
+        with open(fd, mode) as fh:
+            yield fh
+        os.chmod(tmp, 0o666 & ~UMASK)  # mkstemp makes it private; give it the perms open() would have.
+        os.replace(tmp, f)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+
+#########################################
+# Incremental runs (see main.py --incremental).
+#########################################
+
+MANIFEST_VERSION = 3 # 2: contacts have 'sources'. 3: contacts have 'created', 'modified', 'birthday'
+
+def load_manifest(f, base_dir):
+    '''Returns the manifest that the last incremental run left in json file f (see save_manifest), eg,
+
+        {'version': 1,
+         'archive': '/foo/in/My Contacts.abbu',
+         'images': { '/foo/in/My Contacts.abbu/Images/C13384AC-...': {
+                         'size': 12345, 'mtime_ns': 1669132800000000000, 'sha256': '9f86d0...',
+                         'info': 'TIFF image data, big-endian\\n', 'image type': 'tiff',
+                         'dst': '/foo/out/ims/Apple-Inc__C13384AC-....tiff'}, ...},
+         'contacts': { 'C13384AC-...': {'fingerprint': '...', 'contact': {'uid': ..., 'phone': ..., ...}}, ...}
+        }
+
+    or an empty manifest if there isn't one yet, or it's for a different .abbu file or manifest version.
+    '''
+    empty = {'version': MANIFEST_VERSION, 'archive': str(base_dir), 'images': {}, 'contacts': {}}
+    if not Path(f).is_file():
+        log.info('No manifest %s yet, so processing everything.', f)
+        return empty
+    with open(f) as fh:
+        m = json.load(fh)
+    if m.get('version') != MANIFEST_VERSION or m.get('archive') != str(base_dir):
+        log.info('Manifest %s is for a different archive or version (%s, v%s), so processing everything.', f, m.get('archive'), m.get('version'))
+        return empty
+    log.info('Loaded manifest %s: %d images, %d contacts.', f, len(m['images']), len(m['contacts']))
+    return m
+
+def save_manifest(m, f):
+    with atomic_open(f) as fh:
+        json.dump(m, fh, cls=DateTimeEncoder)
+    log.info('Saved manifest %s: %d images, %d contacts.', f, len(m['images']), len(m['contacts']))
+
+def store_file(src, store, h=None, ext=''):
+    '''Content-addressed copy: copy file src to store/<sha256 of its contents><ext>, unless it's already there.
+    Pass h if you already know src's hash. Returns the stored copy's path.
+    src is opened once: hashed through an mmap, then copied from the same (now cached) file by the kernel (see copy_file).
+    '''
+    with open(src,'rb') as fh:
+        if not h:
+            with mapped(fh) as m:
+                h = hashlib.sha256(m).hexdigest()
+        blob = Path(store) / f'{h}{ext}'
+        if not blob.is_file():
+            # Copy to a temp name & rename, so 2 threads storing the same contents can't leave a half-copied file.
+            tmp = blob.with_name(f'.{blob.name}.{threading.get_ident()}.tmp')
+            copy_file(src, tmp, fh)
+            os.replace(tmp, blob)
+    return blob
+
+def link_file(src, dst):
+    '''Make dst a hard link to file src (replacing dst), or a copy of it if the file system can't do hard links.'''
+    Path(dst).unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+def scan_file(f):
+    '''Read file f just once: returns (info, image type, sha256 hex digest), ie, what sniff returns plus the hash of f's contents,
+    hashed through an mmap (no copies into python).'''
+    with open(f,'rb') as fh, mapped(fh) as m:
+        return (*sniff_header(m[:100]), hashlib.sha256(m).hexdigest())
+
+@contextmanager
+def mapped(fh):
+    '''The contents of file fh (open for reading) as a read-only mmap, read in by the OS page by page as it's used,
+    eg, by hashlib, which reads it in C without copying. (b'' for an empty file, which can't be mapped.)
+    '''
+    if os.fstat(fh.fileno()).st_size == 0:
+        yield b''
+        return
+    m = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            m.madvise(mmap.MADV_SEQUENTIAL)  # read ahead more, and drop pages behind sooner
+        yield m
+    finally:
+        m.close()
+
+def copy_file(src, dst, fh=None):
+    '''Copy file src to dst, with its permissions and times, like shutil.copy2, but without reading the data into python:
+    the kernel copies it with copy_file_range (which makes a reflink, sharing the data, on file systems that can, like btrfs & XFS),
+    or else sendfile, or else (eg, on macOS) it's copied in chunks. Pass fh, src already open for reading, to copy from it instead
+    of opening src again (it copies all of src, whatever fh's position).
+    '''
+    with open(src,'rb') if fh is None else nullcontext(fh) as fi, open(dst,'wb') as fo:
+        i, o, off = fi.fileno(), fo.fileno(), 0
+        how = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'sendfile' if hasattr(os, 'sendfile') else None
+        while how:
+            try:
+                if how == 'copy_file_range':
+                    k = os.copy_file_range(i, o, 1 << 30, off, off)
+                else:
+                    k = os.sendfile(o, i, off, 1 << 30)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EPERM):
+                    raise
+                # Eg, copy_file_range between file systems on older kernels, or sendfile to a file (not a socket) on macOS.
+                how = 'sendfile' if how == 'copy_file_range' and hasattr(os, 'sendfile') else None
+                os.lseek(o, off, os.SEEK_SET)
+                continue
+            if k == 0:
+                break
+            off += k
+        else:
+            fi.seek(off)
+            shutil.copyfileobj(fi, fo, 1 << 20)
+    shutil.copystat(src, dst)
+
+
+#########################################
+# Run report: how long each stage of a run took, etc (see main.py, 'out/run_report.json').
+#########################################
+
+@contextmanager
+def stage(report, name, profile_dir=None):
+    '''Measure 1 stage of a run, and append what was measured to the list report['stages']:
+       - wall and CPU seconds (CPU incl. that of child processes, eg, from ppmap),
+       - the process's peak RSS so far (the OS only tracks the peak over the whole run),
+       - the peak memory python allocated during the stage, if tracemalloc is on,
+       - the counts that the 'with' block puts into the dict it gets, eg, {'contacts': 90}.
+       If profile_dir is given, also cProfile the stage into the file profile_dir/<#>-<name>.prof.
+    '''
+    counts = {}
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    prof = None
+    if profile_dir is not None:
+        prof = cProfile.Profile()
+        prof.enable()
+    t0, c0 = time.perf_counter(), cpu_seconds()
+    try:
+        yield counts
+    finally:
+        s = {'stage': name,
+             'seconds': time.perf_counter() - t0,
+             'cpu seconds': cpu_seconds() - c0,
+             'peak rss bytes': peak_rss_bytes()}
+        if tracemalloc.is_tracing():
+            s['tracemalloc peak bytes'] = tracemalloc.get_traced_memory()[1]
+        s['counts'] = counts
+        if prof is not None:
+            prof.disable()
+            prof.dump_stats(Path(profile_dir) / f"{len(report['stages'])+1:02d}-{name}.prof")
+        report['stages'].append(s)
+
+def cpu_seconds():
+    '''User + system CPU time of this process and its (finished) child processes.'''
+    s, c = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
 
-    open(f,'w').write(json.dumps(obj,
-        indent=4,
-        cls=DateTimeEncoder
-        ))
+def peak_rss_bytes():
+    '''The most memory (resident set size) this process has used so far.'''
+    # ru_maxrss is in bytes on macOS, but in KB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
 
-    print(f'DONE: Exporting to file {f}')
@@ -1,24 +1,92 @@
-from pprint import pprint as pp
 from pprint import pformat
 from pathlib import Path
-import plistlib, re, shutil
-from lib import get_file_info, parse_abcddb, gather, merge_dicts, duplicate_freeQ, dict_subsetQ, export
-
-print("DEPRECATION WARNING: I use the stdlib's imghdr module to identify the image type of files. Deprecated in Py 3.11, removed in Py 3.13. More info: https://docs.python.org/3/library/imghdr.html")
-import imghdr
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from functools import cache, partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import argparse, asyncio, datetime, logging, plistlib, re, shutil, threading, time, tracemalloc
+from lib import get_file_info, sniff, sniff_header, pmap, ppmap, scan_file, copy_file, store_file, link_file, parse_abcddb, clear_schemas, iter_contact_rows, record_uids, record_fingerprints, group_by, hashable, duplicate_freeQ, dict_subsetQ, export, export_stream, index_writer, duplicate_features, find_duplicates, load_manifest, save_manifest, stage, cpu_seconds, peak_rss_bytes, log, Pretty, setup_logging, LOG_FORMATS, core_data_date, core_data_day, iso_date, table_has_columnQ, iter_blobs, read_blob, copy_blob
 
 # Parse a Mac Address Book file (.abbu) into JSON. See README.md for details.
 
+def make_parser(add_help=True):
+    '''The command-line options for processing 1 .abbu file (also used by batch.py).'''
+    parser = argparse.ArgumentParser(description='Parse a Mac Address Book file (.abbu) into JSON. See README.md for details.', add_help=add_help)
+    parser.add_argument('--stream', action='store_true',
+        help="Clean, check and copy the contacts' images 1 contact at a time, instead of loading all contacts into memory first.")
+    parser.add_argument('--pipeline', action='store_true',
+        help="Overlap the stages (reading the dbs, .abcdp files and images, cleaning, copying images, exporting), connected by bounded queues. Same output as without it.")
+    parser.add_argument('--jsonl', action='store_true',
+        help="Write 'contacts.jsonl' (1 contact per line) instead of 'contacts.json'.")
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+        help='Read and copy image files and .abcdp files with N threads at once, and parse up to N .abcddb dbs in separate processes. (default: 1)')
+    parser.add_argument('--dedup', action='store_true',
+        help="Store each distinct image just once, in 'out/ims/blobs/', and hard link the image files in 'out/ims/' to those.")
+    parser.add_argument('--incremental', action='store_true',
+        help="Only redo the contacts and images that changed since the last --incremental run, per 'out/manifest.json'.")
+    parser.add_argument('--index', action='store_true',
+        help="Also write 'out/contacts.db', a sqlite db of the contacts, indexed for quick lookups by name, email or phone (see search.py).")
+    parser.add_argument('--duplicates', action='store_true',
+        help="Also write 'out/duplicates.json': clusters of contacts that are likely the same person under different UIDs (same email, phone or name).")
+    parser.add_argument('--thumbnails', action='store_true',
+        help="Also save each contact's thumbnail image, stored in the db, to 'out/ims/thumbs/<uid>.<ext>'.")
+    parser.add_argument('--modified-since', type=iso_date, default=None, metavar='DATE',
+        help="Only export the contacts modified at or after DATE, eg, '2023-03-08' or '2023-03-08T20:26:40-08:00' (UTC if no time zone), and only copy their images.")
+    parser.add_argument('--profile', action='store_true',
+        help="Also cProfile each stage into 'out/profile/<#>-<stage>.prof', and track python's memory use with tracemalloc (slower).")
+    parser.add_argument('--quiet', '-q', action='store_true',
+        help='Only log warnings and errors.')
+    parser.add_argument('--verbose', '-v', action='store_true',
+        help='Also log details, like example records, table sizes, and contacts with duplicate images (slower).')
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default='text',
+        help="Log plain text, or 1 json object per line. (default: text)")
+    return parser
+
+def check_args(parser, args):
+    if args.incremental and args.stream:
+        parser.error('--incremental and --stream do not work together.')
+    if args.pipeline and (args.stream or args.incremental):
+        parser.error('--pipeline does not work with --stream or --incremental.')
+    if args.quiet and args.verbose:
+        parser.error('--quiet and --verbose do not work together.')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+
+def configure_logging(quiet=False, verbose=False, log_format='text'):
+    '''Set up logging per the command-line options --quiet, --verbose and --log-format (see make_parser).'''
+    setup_logging(logging.WARNING if quiet else logging.DEBUG if verbose else logging.INFO, log_format)
+
 def main():
+    parser = make_parser()
+    args = parser.parse_args()
+    check_args(parser, args)
+    configure_logging(args.quiet, args.verbose, args.log_format)
+
     dirs = list(Path('./in/').glob('*.abbu'))
     assert len(dirs)==1, 'Expected exactly 1 .abbu file in the \'in\' dir!'
 
-    BASE_DIR = dirs[0].absolute()
-    assert BASE_DIR.is_dir()
-
     OUT_DIR = Path('./out').absolute()
     assert OUT_DIR.is_dir()
 
+    try:
+        run(dirs[0].absolute(), OUT_DIR, args)
+    finally:
+        clear_schemas()
+
+
+def run(BASE_DIR : Path, OUT_DIR : Path, args):
+    '''Parse the .abbu dir BASE_DIR into OUT_DIR, per the command-line args (see make_parser).
+    Returns some counts, eg, {'contacts': 90, 'images': 120, 'orphaned images': 40}.
+    '''
+    assert BASE_DIR.is_dir()
+    assert OUT_DIR.is_dir()
+
+    OUT_CONTACTS = OUT_DIR / ('contacts.jsonl' if args.jsonl else 'contacts.json')
+    OUT_INDEX = OUT_DIR / 'contacts.db' if args.index else None
+    OUT_DUPLICATES = OUT_DIR / 'duplicates.json'
+
     OUT_IMS_DIR = OUT_DIR / 'ims'
     if not OUT_IMS_DIR.exists():
         OUT_IMS_DIR.mkdir()
@@ -27,82 +95,323 @@ def main():
     if not OUT_ORPHAN_IMS_DIR.exists():
         OUT_ORPHAN_IMS_DIR.mkdir()
 
-    print(f'Parsing this ".abbu" mac address book:\n{BASE_DIR}')
+    OUT_THUMBS_DIR = OUT_IMS_DIR / 'thumbs'
+    if args.thumbnails:
+        OUT_THUMBS_DIR.mkdir(exist_ok=True)
+
+    OUT_STORE_DIR = None
+    if args.dedup:
+        OUT_STORE_DIR = OUT_IMS_DIR / 'blobs'
+        OUT_STORE_DIR.mkdir(exist_ok=True)
+
+    log.info('Parsing this ".abbu" mac address book:\n%s', BASE_DIR)
 
     assert (BASE_DIR / 'Metadata').is_dir(), f'Expected given dir "{BASE_DIR}" to have dir "Metadata"!'
     assert (BASE_DIR / 'Sources').is_dir(), f'Expected given dir "{BASE_DIR}" to have dir "Sources"!'
     assert (BASE_DIR / 'AddressBook-v22.abcddb').is_file(), f'Expected given dir "{BASE_DIR}" to have file "AddressBook-v22.abcddb"!'
     assert get_file_info(BASE_DIR / 'AddressBook-v22.abcddb').startswith('SQLite 3.x database'), f'''Expected file "{BASE_DIR / 'AddressBook-v22.abcddb'}" to be a SQLite db!'''
 
-    ps = load_people(BASE_DIR)
-    ims = load_image_files(BASE_DIR)
-    cs = load_contacts(BASE_DIR)
-    ps = clean_people(ps)
-    cs = clean_contacts(cs)
-    verify_people_are_subset_of_contacts(ps,cs)
-    orphaned_ims, cs = merge_images_into_contacts(ims,cs)
-    actually_copy_and_rename_image_files(cs, OUT_IMS_DIR)
-    actually_copy_and_rename_ORPHANED_image_files(orphaned_ims, OUT_ORPHAN_IMS_DIR)
-    export(cs,OUT_DIR / 'contacts.json')
-
-    print('bye!!')
-
-
-def load_people(base_dir : Path):
-    print('START: PEOPLE (.abcdp files)')
-    ps = []
-    for f in base_dir.glob('**/*.abcdp'):
-        d = plistlib.load(open(f,'rb'))
-        if 'UID' not in d: 
-            raise ValueError(f"ERROR: No UID in file\n{f}\nDict:\n{pformat(d,indent=4)}\n""")
-        if not d['UID'].endswith(':ABPerson'): 
-            raise ValueError(f"""ERROR: Expected UID '{d['UID']}' to end with ':ABPerson' from this dict:\n{pformat(d,indent=4)}\nfrom file:\n{f}""")
-        ps.append(d)
-    print(f"Done parsing {len(ps)} .abcdp people files into variable 'ps'.")
+    # Measure each stage into 'out/run_report.json' (see lib.stage).
+    report = {'archive': str(BASE_DIR), 'args': vars(args), 'stages': []}
+    profile_dir = None
+    if args.profile:
+        profile_dir = OUT_DIR / 'profile'
+        profile_dir.mkdir(exist_ok=True)
+        tracemalloc.start()
+    timed = lambda name: stage(report, name, profile_dir)
+    t0, c0 = time.perf_counter(), cpu_seconds()
+
+    if args.stream:
+        with timed('load_people') as n:
+            ps = load_people(BASE_DIR, args.jobs)
+            n['people'] = len(ps)
+        with timed('load_image_files') as n:
+            ims = load_image_files(BASE_DIR, args.jobs)
+            n['images'] = n_ims = len(ims)
+        with timed('clean_people') as n:
+            ps = clean_people(ps)
+            n['people'] = len(ps)
+        with timed('stream') as n:
+            cs = stream_contacts(BASE_DIR, ps, ims, OUT_IMS_DIR, args.jobs, OUT_STORE_DIR, n, args.modified_since)
+            if args.duplicates:
+                # Keep just what find_duplicates needs of each contact as it goes by.
+                fs = []
+                cs = (fs.append(duplicate_features(c)) or c for c in cs)
+            n['contacts'] = n_cs = export_contacts(cs, OUT_CONTACTS, args.jsonl, OUT_INDEX)
+        if args.duplicates:
+            with timed('duplicates') as n:
+                n.update(export_duplicates(fs, OUT_DUPLICATES))
+        with timed('copy_orphans') as n:
+            n.update(actually_copy_and_rename_ORPHANED_image_files(ims, OUT_ORPHAN_IMS_DIR, args.jobs, store=OUT_STORE_DIR))
+        if args.thumbnails:
+            with timed('thumbnails') as n:
+                n.update(export_thumbnails(BASE_DIR, OUT_THUMBS_DIR))
+        if args.dedup:
+            with timed('prune_image_store'):
+                prune_image_store(OUT_STORE_DIR)
+        counts = {'contacts': n_cs, 'images': n_ims, 'orphaned images': len(ims)}
+    elif args.pipeline:
+        with timed('pipeline') as n:
+            fs = [] if args.duplicates else None
+            n_cs, n_ims, orphaned_ims = asyncio.run(run_pipeline(BASE_DIR, OUT_CONTACTS, OUT_IMS_DIR, args, n, OUT_INDEX, OUT_STORE_DIR,
+                                                                 OUT_THUMBS_DIR if args.thumbnails else None, fs))
+        with timed('copy_orphans') as n:
+            n.update(actually_copy_and_rename_ORPHANED_image_files(orphaned_ims, OUT_ORPHAN_IMS_DIR, args.jobs, store=OUT_STORE_DIR))
+        if args.duplicates:
+            with timed('duplicates') as n:
+                n.update(export_duplicates(fs, OUT_DUPLICATES))
+        if args.dedup:
+            with timed('prune_image_store'):
+                prune_image_store(OUT_STORE_DIR)
+        counts = {'contacts': n_cs, 'images': n_ims, 'orphaned images': len(orphaned_ims)}
+    else:
+        manifest, prev_images = None, {}
+        if args.incremental:
+            manifest = load_manifest(OUT_DIR / 'manifest.json', BASE_DIR)
+            prev_images = manifest['images']
+
+        with timed('load_people') as n:
+            ps = load_people(BASE_DIR, args.jobs)
+            n['people'] = len(ps)
+        with timed('load_image_files') as n:
+            ims = load_image_files(BASE_DIR, args.jobs, manifest)
+            n['images'] = len(ims)
+        if args.incremental:
+            with timed('load_contacts_incrementally') as n:
+                cs = load_contacts_incrementally(BASE_DIR, manifest)
+                n['contacts'] = len(cs)
+            with timed('clean_people') as n:
+                ps = clean_people(ps)
+                n['people'] = len(ps)
+        else:
+            with timed('load_contacts') as n:
+                cs = load_contacts(BASE_DIR, args.jobs)
+                n['rows'] = len(cs)
+            with timed('clean_people') as n:
+                ps = clean_people(ps)
+                n['people'] = len(ps)
+            with timed('clean_contacts') as n:
+                cs = clean_contacts(cs)
+                n['contacts'] = len(cs)
+        with timed('uid_index'):
+            index = uid_index(cs,ims)
+        with timed('verify') as n:
+            verify_people_are_subset_of_contacts(ps,cs,index)
+            n['people'] = len(ps)
+        with timed('merge') as n:
+            orphaned_ims, cs = merge_images_into_contacts(ims,cs,index)
+            n['orphaned images'] = len(orphaned_ims)
+        if args.modified_since:
+            with timed('modified_since') as n:
+                cs = [c for c in cs if modified_sinceQ(c, args.modified_since)]
+                n['contacts'] = len(cs)
+                log.info('%d contacts were modified since %s.', len(cs), args.modified_since)
+        with timed('copy') as n:
+            n.update(actually_copy_and_rename_image_files(cs, OUT_IMS_DIR, args.jobs, manifest, prev_images, OUT_STORE_DIR))
+        with timed('copy_orphans') as n:
+            n.update(actually_copy_and_rename_ORPHANED_image_files(orphaned_ims, OUT_ORPHAN_IMS_DIR, args.jobs, manifest, prev_images, OUT_STORE_DIR))
+        if args.thumbnails:
+            with timed('thumbnails') as n:
+                n.update(export_thumbnails(BASE_DIR, OUT_THUMBS_DIR))
+        if args.duplicates:
+            with timed('duplicates') as n:
+                n.update(export_duplicates(map(duplicate_features, cs), OUT_DUPLICATES))
+        with timed('export') as n:
+            n['contacts'] = export_contacts(cs, OUT_CONTACTS, args.jsonl, OUT_INDEX)
+        if args.incremental:
+            with timed('save_manifest'):
+                remove_stale_outputs(manifest, prev_images)
+                save_manifest(manifest, OUT_DIR / 'manifest.json')
+        if args.dedup:
+            with timed('prune_image_store'):
+                prune_image_store(OUT_STORE_DIR)
+        counts = {'contacts': len(cs), 'images': len(ims), 'orphaned images': len(orphaned_ims)}
+
+    report.update({'seconds': time.perf_counter() - t0, 'cpu seconds': cpu_seconds() - c0, 'peak rss bytes': peak_rss_bytes(), 'counts': counts})
+    if args.profile:
+        tracemalloc.stop()
+    export(report, OUT_DIR / 'run_report.json')
+    log.info('bye!!')
+    return counts
+
+
+def export_contacts(cs, f, jsonl=False, index=None):
+    '''Export contacts cs (see Contact.as_dict) to json file f (see export_stream), 1 at a time,
+    and if given index, to that search index db file too, in the same pass (see index_writer).
+    Returns the # of contacts exported.
+    '''
+    ds = map(Contact.as_dict, cs)
+    if index is None:
+        return export_stream(ds, f, jsonl)
+    with index_writer(index) as add:
+        return export_stream(map(add, ds), f, jsonl)
+
+
+def export_duplicates(fs, f):
+    '''Find the likely duplicate contacts, from their duplicate_features fs (see lib.find_duplicates), and export the report to json file f.
+    Returns some counts, eg, {'candidate pairs': 120, 'clusters': 8, 'contacts in clusters': 17}.
+    '''
+    r = find_duplicates(fs)
+    export(r, f)
+    return {'candidate pairs': r['candidate pairs'], 'clusters': len(r['clusters']), 'contacts in clusters': sum(len(c['uids']) for c in r['clusters'])}
+
+
+def load_people(base_dir : Path, jobs=1):
+    log.info('START: PEOPLE (.abcdp files)')
+    fs = sorted(base_dir.glob('**/*.abcdp'))
+    ps = pmap(load_person, fs, jobs)
+    log.info("Done parsing %d .abcdp people files into variable 'ps'.", len(ps))
     if len(ps)>0:
-        print('Example:')
-        pp(ps[0])
+        log.debug('Example:\n%s', Pretty(ps[0]))
 
     return ps
 
-def load_image_files(base_dir : Path):
+def load_person(f : Path):
+    '''Read 1 .abcdp plist file into a dict.'''
+    with open(f,'rb') as fh:
+        d = plistlib.load(fh)
+    if 'UID' not in d: 
+        raise ValueError(f"ERROR: No UID in file\n{f}\nDict:\n{pformat(d,indent=4)}\n""")
+    if not d['UID'].endswith(':ABPerson'): 
+        raise ValueError(f"""ERROR: Expected UID '{d['UID']}' to end with ':ABPerson' from this dict:\n{pformat(d,indent=4)}\nfrom file:\n{f}""")
+    return d
+
+def load_image_files(base_dir : Path, jobs=1, manifest=None):
     # Image, stored w/ or w/o file extension, in Images dir
-    print('START: IMAGES (any file in any Images/ dir)')
-    ims = [{  'path': f,
-              'info': get_file_info(f), 
-              'image type':imghdr.what(f),
-              'base name':f.stem
-            } for f in base_dir.glob('**/Images/*') if f.is_file()]
-    print(f"Done parsing {len(ims)} images from Images directory(s) into variable 'ims'!")
+    log.info('START: IMAGES (any file in any Images/ dir)')
+    fs = [f for f in base_dir.glob('**/Images/*') if f.is_file()]
+    if manifest is None:
+        sniffs = pmap(sniff,fs,jobs)
+    else:
+        # Re-use what the last incremental run found out about the files that haven't changed (same size & mtime),
+        # and hash the rest. manifest['images'] is replaced with entries for just the current files.
+        prev = manifest['images']
+        def look(f):
+            st = f.stat()
+            e = prev.get(str(f))
+            if e and e['size']==st.st_size and e['mtime_ns']==st.st_mtime_ns:
+                return {k: e[k] for k in ['size','mtime_ns','sha256','info','image type']}
+            info, t, h = scan_file(f)
+            return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': h, 'info': info, 'image type': t}
+        es = pmap(look,fs,jobs)
+        manifest['images'] = {str(f): e for f,e in zip(fs,es)}
+        sniffs = [(e['info'],e['image type']) for e in es]
+    ims = [{ 'path': f,
+             'info': info,
+             'image type': t,
+             'base name': f.stem
+           } for f,(info,t) in zip(fs, sniffs)]
+    log.info("Done parsing %d images from Images directory(s) into variable 'ims'!", len(ims))
     if len(ims)>0:
-        print("Example:")
-        pp(ims[0])
+        log.debug('Example:\n%s', Pretty(ims[0]))
 
     return ims
 
-def load_contacts(base_dir : Path):
-    print('START: DATABASES (.abcddb dirs)')
+def load_contacts(base_dir : Path, jobs=1):
+    log.info('START: DATABASES (.abcddb dirs)')
     cs = []
-    fs = list(base_dir.glob('**/*.abcddb')) # Address book, stored as sqlite3 db
-    for f in fs:
-        ds = parse_abcddb(f) # Each dict is a row from the abcddb's sqlite db query.
-        for d in ds:
-            if 'ZABCDRECORD.ZUNIQUEID' not in d:
-                print(f"Warning: Skipping dict w/ no 'ZABCDRECORD.ZUNIQUEID':\n{pformat(d,indent=4)}")
-                continue
-            if not d['ZABCDRECORD.ZUNIQUEID'].endswith(':ABPerson'):
-                print(f"Info: Expected record's 'ZABCDRECORD.ZUNIQUEID' to end with ':ABPerson', skipping:\n{pformat(d,indent=4)}")
-                continue
-            cs.append(d)
-    print(f"Done parsing {len(cs)} contacts from {len(fs)} .abcddb SQLite databases, into variable 'cs'!")
+    fs = find_dbs(base_dir)
+    # Parse the dbs (the root one, plus 1 per Sources/<uuid>/ account) in separate processes,
+    # then combine them in the order of fs, so the result doesn't depend on which finishes first.
+    # Each dict is a row from the abcddb's sqlite db query, with its keys already renamed (see CONTACT_FIELDS).
+    for f,ds in zip(fs, ppmap(partial(parse_abcddb, fields=CONTACT_FIELDS, convert=CONTACT_KEY_CONVERTERS), fs, jobs)):
+        cs.extend(tag_source(d, f, base_dir) for d in ds if contact_rowQ(d))
+    log.info("Done parsing %d contacts from %d .abcddb SQLite databases, into variable 'cs'!", len(cs), len(fs))
     if len(cs)>0:
-        print("Example:")
-        pp(cs[0])
+        log.debug('Example:\n%s', Pretty(cs[0]))
+
+    return cs
+
+def find_dbs(base_dir : Path):
+    '''Returns the .abcddb files in base_dir (the address book, stored as sqlite3 dbs), in a fixed order:
+    the root 'AddressBook-v22.abcddb' first, then the ones under 'Sources/', sorted.
+    '''
+    return sorted(base_dir.glob('**/*.abcddb'), key=lambda f: (f.parent != base_dir, f))
+
+def tag_source(d, db : Path, base_dir : Path):
+    '''Note in row d which db it came from, eg, 'Sources/<uuid>/AddressBook-v22.abcddb'.
+    It's a list, so that merging a contact's rows from several dbs lists all of them.
+    '''
+    d['sources'] = [str(db.relative_to(base_dir))]
+    return d
+
+def load_contacts_incrementally(base_dir : Path, manifest):
+    '''Like load_contacts + clean_contacts, but only query & clean the contacts whose records changed
+    since the last incremental run; re-use the manifest's cleaned copy of the rest.
+    A contact's fingerprint is made from the fingerprints of all its records (see record_fingerprints).
+    Replaces manifest['contacts'] with the current contacts.
+    '''
+    log.info('START: DATABASES (.abcddb dirs), incrementally')
+    fs = find_dbs(base_dir)
+    records = {}  # uid -> [(db, Z_PK, fingerprint), ...], in the same order that load_contacts sees them
+    for f in fs:
+        for pk,uid,fp in record_fingerprints(f):
+            records.setdefault(uid.replace(':ABPerson',''),[]).append((f,pk,fp))
+    fps = {uid: repr([(str(f.relative_to(base_dir)),pk,fp) for f,pk,fp in rs]) for uid,rs in records.items()}
+    prev = manifest['contacts']
+    changed = {uid for uid in records if uid not in prev or prev[uid]['fingerprint'] != fps[uid]}
+    log.info('%d/%d contacts are new or changed since the last run; %d were removed.', len(changed), len(records), len(set(prev)-set(records)))
+
+    ds = []
+    for f in fs:
+        pks = [pk for uid in changed for g,pk,fp in records[uid] if g == f]
+        if pks:
+            ds.extend(tag_source(d, f, base_dir) for pk,rs in iter_contact_rows(f, pks=pks, fields=CONTACT_FIELDS, convert=CONTACT_KEY_CONVERTERS) for d in rs if contact_rowQ(d))
+    fresh = {c['uid']: c for c in clean_contacts(ds)} if ds else {}
+    cs = [fresh[uid] if uid in changed else Contact.from_dict(prev[uid]['contact']) for uid in records]
 
+    manifest['contacts'] = {c['uid']: {'fingerprint': fps[c['uid']], 'contact': c.as_dict()} for c in cs}
+    log.info("Done loading %d contacts (%d from the dbs) into variable 'cs'!", len(cs), len(fresh))
     return cs
 
+def contact_rowQ(d):
+    '''Returns True if the given row from the abcddb's sqlite db query is a person (not a group, etc).'''
+    if 'uid' not in d:
+        log.warning("Warning: Skipping dict w/ no 'uid' ('ZABCDRECORD.ZUNIQUEID'):\n%s", Pretty(d))
+        return False
+    if not d['uid'].endswith(':ABPerson'):
+        log.debug("Info: Expected record's 'uid' ('ZABCDRECORD.ZUNIQUEID') to end with ':ABPerson', skipping:\n%s", Pretty(d))
+        return False
+    return True
+
+def iter_contacts(db : Path, base_dir : Path):
+    '''Generator: yield the contacts in the given .abcddb (in base_dir) one at a time, fully cleaned.
+    Same as load_contacts + clean_contacts, but streaming: only 1 contact's rows are in memory at a time.
+    '''
+    assert str(db).endswith('.abcddb')
+    assert 'SQLite 3.x database' in get_file_info(db)
+    for pk,ds in iter_contact_rows(db, fields=CONTACT_FIELDS, convert=CONTACT_KEY_CONVERTERS):
+        ds = [clean_contact_row(tag_source(d, db, base_dir)) for d in ds if contact_rowQ(d)]
+        if ds:
+            yield merge_contacts(ds)[0]
+
+def iter_all_contacts(base_dir : Path):
+    '''Generator: yield the contacts from all the .abcddb dbs in base_dir, one at a time (see iter_contacts).
+
+    A UID can show up in more than 1 record, eg, in 2 different dbs. clean_contacts merges those,
+    so to do the same here, we first count each UID, and hold on to the records of a repeated UID
+    until we've seen all of them. So a repeated-UID contact comes out at the position of its last record, not its first.
+    '''
+    fs = find_dbs(base_dir)
+    n = record_counts(fs)
+    parts = {}
+    for f in fs:
+        log.info('START: stream contacts from %s', f)
+        for c in iter_contacts(f, base_dir):
+            if n[c['uid']] == 1:
+                yield c
+                continue
+            parts.setdefault(c['uid'],[]).append(c)
+            if len(parts[c['uid']]) == n[c['uid']]:
+                yield merge_contacts(parts.pop(c['uid']))[0]
+    assert not parts
+
+def record_counts(fs):
+    '''Returns how many person records each UID has in dbs fs (usually 1; more if it's in several dbs).'''
+    return Counter(u.replace(':ABPerson','') for f in fs for u in record_uids(f) if u.endswith(':ABPerson'))
+
 def clean_people(ps):
-    print(f'START: Clean {len(ps)} people.')
+    log.info('START: Clean %d people.', len(ps))
 
     for p in ps:
         # Delete annoying data.
@@ -148,6 +457,11 @@ def clean_people(ps):
     # Lowercase all keys.
     ps = [ {k.lower(): v for k,v in p.items()} for p in ps ]
 
+    # Birthdays are (UTC) datetimes in the .abcdp files: make them ISO dates, like the db's (see core_data_day).
+    for p in ps:
+        if isinstance(p.get('birthday'), datetime.datetime):
+            p['birthday'] = p['birthday'].date().isoformat()
+
     # Rename key 'urls' to 'url'.
     for p in ps:
         if 'urls' in p:
@@ -193,287 +507,766 @@ def clean_people(ps):
     # Check that UID's are unique.
     assert duplicate_freeQ(ps,lambda p: p['uid'])
 
-    print(f'END: Clean {len(ps)} people.')
+    log.info('END: Clean %d people.', len(ps))
     return ps
 
 
 
-def clean_contacts(cs):
-    print(f'START: Clean {len(cs)} contacts.')
-    assert all('ZABCDRECORD.ZUNIQUEID' in c for c in cs), f"Very weird: all contact dicts should have the key 'ZABCDRECORD.ZUNIQUEID'."
-
-    keys_to_delete = [s.strip() for s in str.splitlines('''
-        ZABCDCONTACTINDEX.Z21_CONTACT
-        ZABCDCONTACTINDEX.Z22_CONTACT
-        ZABCDCONTACTINDEX.ZCONTACT
-        ZABCDCONTACTINDEX.ZSTRINGFORINDEXING
-        ZABCDCONTACTINDEX.Z_ENT
-        ZABCDCONTACTINDEX.Z_OPT
-        ZABCDCONTACTINDEX.Z_PK
-        ZABCDEMAILADDRESS.Z21_OWNER
-        ZABCDEMAILADDRESS.Z22_OWNER
-        ZABCDEMAILADDRESS.ZADDRESSNORMALIZED
-        ZABCDEMAILADDRESS.ZISPRIMARY
-        ZABCDEMAILADDRESS.ZORDERINGINDEX
-        ZABCDEMAILADDRESS.ZOWNER
-        ZABCDEMAILADDRESS.ZUNIQUEID
-        ZABCDEMAILADDRESS.Z_ENT
-        ZABCDEMAILADDRESS.Z_OPT
-        ZABCDEMAILADDRESS.Z_PK
-        ZABCDNOTE.Z22_CONTACT
-        ZABCDPHONENUMBER.Z21_OWNER
-        ZABCDPHONENUMBER.Z22_OWNER
-        ZABCDPHONENUMBER.ZIOSLEGACYIDENTIFIER
-        ZABCDPHONENUMBER.ZISPRIMARY
-        ZABCDPHONENUMBER.ZLASTFOURDIGITS
-        ZABCDPHONENUMBER.ZORDERINGINDEX
-        ZABCDPHONENUMBER.ZOWNER
-        ZABCDPHONENUMBER.ZUNIQUEID
-        ZABCDPHONENUMBER.Z_ENT
-        ZABCDPHONENUMBER.Z_OPT
-        ZABCDPHONENUMBER.Z_PK
-        ZABCDPOSTALADDRESS.Z21_OWNER
-        ZABCDPOSTALADDRESS.ZISPRIMARY
-        ZABCDPOSTALADDRESS.ZOWNER
-        ZABCDPOSTALADDRESS.Z22_OWNER
-        ZABCDPOSTALADDRESS.ZUNIQUEID
-        ZABCDPOSTALADDRESS.Z_ENT
-        ZABCDPOSTALADDRESS.Z_OPT
-        ZABCDPOSTALADDRESS.Z_PK
-        ZABCDRECORD.ZCONTACTINDEX
-        ZABCDRECORD.ZCONTAINER1
-        ZABCDRECORD.ZCONTAINERWHERECONTACTISME
-        ZABCDRECORD.ZCREATIONDATE
-        ZABCDRECORD.ZCREATIONDATEYEAR
-        ZABCDRECORD.ZCREATIONDATEYEARLESS
-        ZABCDRECORD.ZDISPLAYFLAGS
-        ZABCDRECORD.ZEXTERNALCOLLECTIONPATH
-        ZABCDRECORD.ZEXTERNALFILENAME
-        ZABCDRECORD.ZEXTERNALHASH
-        ZABCDRECORD.ZEXTERNALMODIFICATIONTAG
-        ZABCDRECORD.ZEXTERNALUUID
-        ZABCDRECORD.ZIOSLEGACYIDENTIFIER
-        ZABCDRECORD.ZLINKID
-        ZABCDRECORD.ZMODIFICATIONDATE
-        ZABCDRECORD.ZMODIFICATIONDATEYEAR
-        ZABCDRECORD.ZMODIFICATIONDATEYEARLESS
-        ZABCDRECORD.ZNOTE
-        ZABCDRECORD.ZPREFERREDFORLINKNAME
-        ZABCDRECORD.ZPREFERREDFORLINKPHOTO
-        ZABCDRECORD.ZSORTINGFIRSTNAME
-        ZABCDRECORD.ZSORTINGLASTNAME
-        ZABCDRECORD.ZSOURCEWHERECONTACTISME
-        ZABCDRECORD.ZSYNCSTATUS
-        ZABCDRECORD.ZTHUMBNAILIMAGEDATA
-        ZABCDRECORD.Z_ENT
-        ZABCDRECORD.Z_OPT
-        ZABCDRECORD.Z_PK
-        ZABCDURLADDRESS.Z21_OWNER
-        ZABCDURLADDRESS.ZISPRIMARY
-        ZABCDURLADDRESS.ZOWNER
-        ZABCDURLADDRESS.ZUNIQUEID
-        ZABCDURLADDRESS.Z_ENT
-        ZABCDURLADDRESS.Z_OPT
-        ZABCDURLADDRESS.Z_PK
-        ZABCDURLADDRESS.Z22_OWNER
-        ''') if s.strip()]
-
-    new_key_names = { \
-            'ZABCDRECORD.ZFIRSTNAME'         : 'first'         ,
-            'ZABCDRECORD.ZLASTNAME'          : 'last'          ,
-            'ZABCDRECORD.ZORGANIZATION'      : 'organization'  ,
-            'ZABCDEMAILADDRESS.ZADDRESS'     : 'email'         ,
-            'ZABCDEMAILADDRESS.ZLABEL'       : 'email type'    ,
-            'ZABCDPHONENUMBER.ZFULLNUMBER'   : 'phone'         ,
-            'ZABCDPHONENUMBER.ZLABEL'        : 'phone type'    ,
-            'ZABCDURLADDRESS.ZURL'           : 'url'           ,
-            'ZABCDURLADDRESS.ZLABEL'         : 'url type'      ,
-            'ZABCDPOSTALADDRESS.ZSTREET'     : 'street'        ,
-            'ZABCDPOSTALADDRESS.ZCITY'       : 'city'          ,
-            'ZABCDPOSTALADDRESS.ZSTATE'      : 'state'         ,
-            'ZABCDPOSTALADDRESS.ZZIPCODE'    : 'zip'           ,
-            'ZABCDPOSTALADDRESS.ZCOUNTRYNAME': 'country'       ,
-            'ZABCDPOSTALADDRESS.ZCOUNTRYCODE': 'country code'  ,
-            'ZABCDPOSTALADDRESS.ZLABEL'      : 'address type'  ,
-            'ZABCDRECORD.ZUNIQUEID'          : 'uid'           
-        }
-
-
-    # For each Contact dict, delete worthless keys and rename other keys.
-    #
-    cs = [ { new_key_names.get(k,k) : v for k,v in d.items() if k not in keys_to_delete } for d in cs]
+CONTACT_KEYS_TO_DELETE = frozenset(s.strip() for s in str.splitlines('''
+    ZABCDCONTACTINDEX.Z21_CONTACT
+    ZABCDCONTACTINDEX.Z22_CONTACT
+    ZABCDCONTACTINDEX.ZCONTACT
+    ZABCDCONTACTINDEX.ZSTRINGFORINDEXING
+    ZABCDCONTACTINDEX.Z_ENT
+    ZABCDCONTACTINDEX.Z_OPT
+    ZABCDCONTACTINDEX.Z_PK
+    ZABCDEMAILADDRESS.Z21_OWNER
+    ZABCDEMAILADDRESS.Z22_OWNER
+    ZABCDEMAILADDRESS.ZADDRESSNORMALIZED
+    ZABCDEMAILADDRESS.ZISPRIMARY
+    ZABCDEMAILADDRESS.ZORDERINGINDEX
+    ZABCDEMAILADDRESS.ZOWNER
+    ZABCDEMAILADDRESS.ZUNIQUEID
+    ZABCDEMAILADDRESS.Z_ENT
+    ZABCDEMAILADDRESS.Z_OPT
+    ZABCDEMAILADDRESS.Z_PK
+    ZABCDNOTE.Z22_CONTACT
+    ZABCDPHONENUMBER.Z21_OWNER
+    ZABCDPHONENUMBER.Z22_OWNER
+    ZABCDPHONENUMBER.ZIOSLEGACYIDENTIFIER
+    ZABCDPHONENUMBER.ZISPRIMARY
+    ZABCDPHONENUMBER.ZLASTFOURDIGITS
+    ZABCDPHONENUMBER.ZORDERINGINDEX
+    ZABCDPHONENUMBER.ZOWNER
+    ZABCDPHONENUMBER.ZUNIQUEID
+    ZABCDPHONENUMBER.Z_ENT
+    ZABCDPHONENUMBER.Z_OPT
+    ZABCDPHONENUMBER.Z_PK
+    ZABCDPOSTALADDRESS.Z21_OWNER
+    ZABCDPOSTALADDRESS.ZISPRIMARY
+    ZABCDPOSTALADDRESS.ZOWNER
+    ZABCDPOSTALADDRESS.Z22_OWNER
+    ZABCDPOSTALADDRESS.ZUNIQUEID
+    ZABCDPOSTALADDRESS.Z_ENT
+    ZABCDPOSTALADDRESS.Z_OPT
+    ZABCDPOSTALADDRESS.Z_PK
+    ZABCDRECORD.ZCONTACTINDEX
+    ZABCDRECORD.ZCONTAINER1
+    ZABCDRECORD.ZCONTAINERWHERECONTACTISME
+    ZABCDRECORD.ZCREATIONDATEYEAR
+    ZABCDRECORD.ZCREATIONDATEYEARLESS
+    ZABCDRECORD.ZDISPLAYFLAGS
+    ZABCDRECORD.ZEXTERNALCOLLECTIONPATH
+    ZABCDRECORD.ZEXTERNALFILENAME
+    ZABCDRECORD.ZEXTERNALHASH
+    ZABCDRECORD.ZEXTERNALMODIFICATIONTAG
+    ZABCDRECORD.ZEXTERNALUUID
+    ZABCDRECORD.ZIOSLEGACYIDENTIFIER
+    ZABCDRECORD.ZLINKID
+    ZABCDRECORD.ZMODIFICATIONDATEYEAR
+    ZABCDRECORD.ZMODIFICATIONDATEYEARLESS
+    ZABCDRECORD.ZNOTE
+    ZABCDRECORD.ZPREFERREDFORLINKNAME
+    ZABCDRECORD.ZPREFERREDFORLINKPHOTO
+    ZABCDRECORD.ZSORTINGFIRSTNAME
+    ZABCDRECORD.ZSORTINGLASTNAME
+    ZABCDRECORD.ZSOURCEWHERECONTACTISME
+    ZABCDRECORD.ZSYNCSTATUS
+    ZABCDRECORD.ZTHUMBNAILIMAGEDATA
+    ZABCDRECORD.Z_ENT
+    ZABCDRECORD.Z_OPT
+    ZABCDRECORD.Z_PK
+    ZABCDURLADDRESS.Z21_OWNER
+    ZABCDURLADDRESS.ZISPRIMARY
+    ZABCDURLADDRESS.ZOWNER
+    ZABCDURLADDRESS.ZUNIQUEID
+    ZABCDURLADDRESS.Z_ENT
+    ZABCDURLADDRESS.Z_OPT
+    ZABCDURLADDRESS.Z_PK
+    ZABCDURLADDRESS.Z22_OWNER
+    ''') if s.strip())
 
+CONTACT_KEY_NAMES = { \
+    'ZABCDRECORD.ZFIRSTNAME'         : 'first'         ,
+    'ZABCDRECORD.ZLASTNAME'          : 'last'          ,
+    'ZABCDRECORD.ZORGANIZATION'      : 'organization'  ,
+    'ZABCDEMAILADDRESS.ZADDRESS'     : 'email'         ,
+    'ZABCDEMAILADDRESS.ZLABEL'       : 'email type'    ,
+    'ZABCDPHONENUMBER.ZFULLNUMBER'   : 'phone'         ,
+    'ZABCDPHONENUMBER.ZLABEL'        : 'phone type'    ,
+    'ZABCDURLADDRESS.ZURL'           : 'url'           ,
+    'ZABCDURLADDRESS.ZLABEL'         : 'url type'      ,
+    'ZABCDPOSTALADDRESS.ZSTREET'     : 'street'        ,
+    'ZABCDPOSTALADDRESS.ZCITY'       : 'city'          ,
+    'ZABCDPOSTALADDRESS.ZSTATE'      : 'state'         ,
+    'ZABCDPOSTALADDRESS.ZZIPCODE'    : 'zip'           ,
+    'ZABCDPOSTALADDRESS.ZCOUNTRYNAME': 'country'       ,
+    'ZABCDPOSTALADDRESS.ZCOUNTRYCODE': 'country code'  ,
+    'ZABCDPOSTALADDRESS.ZLABEL'      : 'address type'  ,
+    'ZABCDRECORD.ZUNIQUEID'          : 'uid'           ,
+    'ZABCDRECORD.ZCREATIONDATE'      : 'created'       ,
+    'ZABCDRECORD.ZMODIFICATIONDATE'  : 'modified'      ,
+    'ZABCDRECORD.ZBIRTHDAY'          : 'birthday'      
+}
 
-    # Remove :ABPerson suffix on UIDs.
-    #
-    for d in cs:
-        d['uid'] = d['uid'].replace(':ABPerson','')
+# The db stores dates as Core Data floats; turn them into ISO strings as the rows are fetched (see iter_contact_rows).
+CONTACT_KEY_CONVERTERS = {
+    'created'  : core_data_date,
+    'modified' : core_data_date,
+    'birthday' : core_data_day,
+}
 
-    # For phone, email, urls, convert    
-    # 
-    #   'phone': '+123-123-1234',
-    #   'phone type': '_$!<Mobile>!$_',
-    #
-    # into like how 'ps' does it:
-    #
-    # 'phone': [('Mobile', '123-123-1234'), ...]
-    #
-    for d in cs:
-        for k in ['phone','url','email']:
-            if k in d:
-                ktype = k + ' type'
-                if ktype in d: # normal case
-                    lab = d[ktype].replace('_$!<','').replace('>!$_','')
-                else:
-                    lab = '' # hack around the rare case where there's no 'phone type'
-                val = d[k]
-                d[k] = [(lab,val)]
-                if ktype in d:
-                    d.pop(ktype)
-
-    # For address, gather relevant fields into a dict, ie, convert
-    #
-    # {'address type': '_$!<Work>!$_',
-    #   'city': 'Cupertino',
-    #   'country': 'United States',
-    #   'country code': 'us',
-    #   'organization': 'Apple Inc.',
-    #   'phone': '1-800-MY-APPLE',
-    #   'phone type': '_$!<Main>!$_',
-    #   'state': 'CA',
-    #   'street': '1 Infinite Loop',
-    #   'uid': 'C13384AC-D081-4190-B5CB-DAEEE889A64D:ABPerson',
-    #   'url': 'http://www.apple.com',
-    #   'url type': '_$!<HomePage>!$_',
-    #   'zip': '95014'},
-    #
-    # into
-    #
-    # {'address': [('Work',
-    #                {'city': 'Cupertino',
-    #                 'country': 'United States',
-    #                 'country code': 'us',
-    #                 'state': 'CA',
-    #                 'street': '1 Infinite Loop',
-    #                 'zip': '95014'})],
-    #   'organization': 'Apple Inc.',
-    #   'phone': [('Main', '1-800-MY-APPLE')],
-    #   'uid': 'C13384AC-D081-4190-B5CB-DAEEE889A64D',
-    #   'url': [('HomePage', 'http://www.apple.com')]}    
-    #
-    #
-    ktype = 'address type'
-    addr_keys = ['street','city','state','zip','country','country code']
-    for d in cs:
-        if ktype in d:
-            t = d[ktype].replace('_$!<','').replace('>!$_','')
-            a = {k: d[k] for k in addr_keys if k in d}
-            d['address'] = [(t,a)]
-            [d.pop(k) for k in addr_keys+[ktype]]
+
+# The field map for the db query (see lib.plan_contact_query): the key each column gets in a contact row,
+# or None to not even select it. Other columns are kept as 'TABLE.COLUMN', like 'ZABCDNOTE.ZTEXT'.
+# Tables that aren't in here are kept the same way, and a warning names them and their columns, to add here.
+CONTACT_FIELDS = {**dict.fromkeys(CONTACT_KEYS_TO_DELETE), **CONTACT_KEY_NAMES}
+
+@cache
+def clean_label(s):
+    '''Eg, '_$!<Mobile>!$_' -> 'Mobile'. (There are only a handful of distinct labels, so cache them.)'''
+    return s.replace('_$!<','').replace('>!$_','')
+
+
+ADDRESS_FIELDS = ('street','city','state','zip','country','country code')
+LABELED_FIELDS = {'phone type': 'phone', 'url type': 'url', 'email type': 'email', 'address type': 'address'}
+
+class Contact(Mapping):
+    '''A cleaned contact (see clean_contact_row), stored compactly: millions of these can be in memory at once.
+
+    The usual fields are slots, and the rest (like 'ZABCDNOTE.ZTEXT') go in the dict 'extra'.
+    Phones, emails and urls are lists of (label, value) tuples, and addresses are lists of
+    (label, (street, city, state, zip, country, country code)) tuples, with None for a missing field.
+    'order' is the order of the contact's keys (the order the old dicts had, which the JSON keeps);
+    contacts share these tuples, since there are only a few distinct ones.
+
+    It reads like the dict it replaced, eg, c['uid'], 'ims' in c, c.get('first'), with addresses as
+    (label, {'street': ..., ...}), like clean_people's. Use as_dict to export it.
+    '''
+    __slots__ = ('order','uid','first','last','organization','created','modified','birthday','phone','email','url','sources','address','ims','extra')
+    FIELDS = frozenset(__slots__[1:-1])
+    orders = {}
+
+    def __init__(self):
+        self.order = ()
+        self.uid = self.first = self.last = self.organization = None
+        self.created = self.modified = self.birthday = None
+        self.phone = self.email = self.url = self.sources = self.address = self.ims = None
+        self.extra = None
+
+    def set_order(self, ks):
+        self.order = Contact.orders.setdefault(ks, ks)
+
+    def __getitem__(self, k):
+        if k in Contact.FIELDS:
+            v = getattr(self, k)
+            if v is None:
+                raise KeyError(k)
+            if k == 'address':
+                return [(lab, {f: x for f,x in zip(ADDRESS_FIELDS,a) if x is not None}) for lab,a in v]
+            return v
+        if self.extra is None:
+            raise KeyError(k)
+        return self.extra[k]
+
+    def __setitem__(self, k, v):
+        if k == 'address':
+            v = [(lab, tuple(a.get(f) for f in ADDRESS_FIELDS)) for lab,a in v]
+        if k in Contact.FIELDS:
+            setattr(self, k, v)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[k] = v
+        if k not in self.order:
+            self.set_order(self.order + (k,))
+
+    def __contains__(self, k):
+        return k in self.order
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __repr__(self):
+        return f'Contact({self.as_dict()!r})'
+
+    def as_dict(self):
+        '''This contact as the dict that goes in the JSON, eg, {'uid': ..., 'first': ..., 'phone': [('Mobile', '123-123-1234')], ...}.'''
+        return {k: self[k] for k in self.order}
+
+    @classmethod
+    def from_dict(cls, d):
+        '''Undo as_dict, even after a trip through json (which turns tuples into lists).'''
+        c = cls()
+        for k,v in d.items():
+            if type(v) == list:
+                v = [tuple(x) if type(x) == list else x for x in v]
+            c[k] = v
+        return c
+
+    def merge(self, c):
+        '''Smoosh contact c (with the same uid) into this one:
+        add c's new list elements to this one's lists (like an ordered set, checked with a set of hashable versions), and
+        raise error for colliding keys whose values differ and are NOT lists.
+        Except for dates: a contact in several dbs was created when its 1st record was, and modified when its last one was.
+        '''
+        for k in c.order:
+            if k not in self.order:
+                v = c.get_raw(k)
+                self.set_raw(k, list(v) if type(v) == list else v)
+                self.set_order(self.order + (k,))
+                continue
+            v, w = self.get_raw(k), c.get_raw(k)
+            if k == 'created' or k == 'modified':
+                self.set_raw(k, min(v,w) if k == 'created' else max(v,w))
+                continue
+            if type(v) != list or type(w) != list:
+                if v == w:
+                    continue # ok, already have it
+                raise ValueError(f"Uh oh: different vals and non-lists: key '{k}', z[k] = '{v}'', y[k] = '{w}'")
+            seen = set(map(hashable, v))
+            for x in w:
+                h = hashable(x)
+                if h not in seen:
+                    seen.add(h)
+                    v.append(x)
+
+    def get_raw(self, k):
+        return getattr(self, k) if k in Contact.FIELDS else self.extra[k]
+
+    def set_raw(self, k, v):
+        if k in Contact.FIELDS:
+            setattr(self, k, v)
         else:
-            if any(k in d for k in addr_keys):
-                raise ValueError(f"Found some address-related fields, but no 'address type'!: {d}")
+            if self.extra is None:
+                self.extra = {}
+            self.extra[k] = v
+
+
+def clean_contact_row(d):
+    '''Clean 1 row from the abcddb's sqlite db query into a Contact (see clean_contacts).
+    The row's worthless keys are already dropped and the rest renamed, by the query itself (see CONTACT_FIELDS).
+
+    Removes the :ABPerson suffix on its UID, and for phone, email, urls, converts
+
+      'phone': '+123-123-1234',
+      'phone type': '_$!<Mobile>!$_',
+
+    into like how 'ps' does it:
+
+      'phone': [('Mobile', '123-123-1234'), ...]
+
+    And for address, gathers the relevant fields, ie, converts
+
+      'address type': '_$!<Work>!$_',
+      'city': 'Cupertino',
+      'country': 'United States',
+      'country code': 'us',
+      'state': 'CA',
+      'street': '1 Infinite Loop',
+      'zip': '95014',
+
+    into (label, (street, city, state, zip, country, country code)), ie, as a dict:
+
+      'address': [('Work',
+                   {'city': 'Cupertino',
+                    'country': 'United States',
+                    'country code': 'us',
+                    'state': 'CA',
+                    'street': '1 Infinite Loop',
+                    'zip': '95014'})]
 
+    The dates ('created', 'modified', 'birthday', already ISO strings; see CONTACT_KEY_CONVERTERS) and then
+    the address go last, after all the row's other keys.
+    '''
+    c = Contact()
+    ks = []
+    for k,v in d.items():
+        if k in ADDRESS_FIELDS or k == 'address type' or k in CONTACT_KEY_CONVERTERS:
+            continue
+        if k in LABELED_FIELDS and LABELED_FIELDS[k] in d:
+            continue
+        if k == 'uid':
+            v = v.replace(':ABPerson','')
+        elif k == 'phone' or k == 'url' or k == 'email':
+            v = [(clean_label(d.get(k+' type','')), v)] # '' is a hack around the rare case where there's no 'phone type'
+        c.set_raw(k, v)
+        ks.append(k)
+
+    for k in CONTACT_KEY_CONVERTERS:
+        if k in d:
+            c.set_raw(k, d[k])
+            ks.append(k)
+
+    if 'address type' in d:
+        c.address = [(clean_label(d['address type']), tuple(d.get(k) for k in ADDRESS_FIELDS))]
+        ks.append('address')
+    elif any(k in d for k in ADDRESS_FIELDS):
+        raise ValueError(f"Found some address-related fields, but no 'address type'!: {d}")
+
+    c.set_order(tuple(ks))
+    return c
+
+
+def merge_contacts(cs):
+    '''Merge the contacts that have the same UID (see Contact.merge), in order of each UID's 1st appearance.'''
+    merged = {}
+    for c in cs:
+        m = merged.get(c.uid)
+        if m is None:
+            merged[c.uid] = c
+        else:
+            m.merge(c)
+    return list(merged.values())
+
+
+def clean_contacts(cs):
+    log.info('START: Clean %d contacts.', len(cs))
+    assert all('uid' in c for c in cs), f"Very weird: all contact dicts should have the key 'uid' ('ZABCDRECORD.ZUNIQUEID')."
+
+    cs = [clean_contact_row(d) for d in cs]
 
     # Merge contacts who have the same UID.
+    # (UID isn't unique, prob bc some contact has multiple types of phone / email / url / address.)
     #
-    if not duplicate_freeQ(cs, lambda c: c['uid']):
-        print(f"INFO: UID isn't unique, prob bc some contact has multiple types of phone / email / url / address. Merging...")
-        print(f'Merging {len(cs)} contacts by UID...')
-        cs = list(map(merge_dicts, gather(cs,lambda c: c['uid'])))
-        print(f'Done; now have {len(cs)} contacts.')
-
-    assert duplicate_freeQ(cs, lambda c: c['uid'])
-    print(f'{len(cs)} UIDs are unique, good.')
+    log.info('Merging %d contacts by UID...', len(cs))
+    cs = merge_contacts(cs)
+    log.info('Done; now have %d contacts, and their UIDs are unique.', len(cs))
 
-    print(f'DONE: Cleaning {len(cs)} contacts.')
+    log.info('DONE: Cleaning %d contacts.', len(cs))
     return cs
 
 
-def verify_people_are_subset_of_contacts(ps,cs):
-    print(f"START: verify each .abcdp 'person' data ({len(ps)}) is a sub-dict of 1 db-based contact ({len(cs)}).")
+def uid_index(cs, ims=()):
+    '''Returns 2 dicts for looking up things by UID:
+    - from UID to the contact with that UID,
+    - from UID to the list of images named after it (its 'base name').
+    Build it once and pass it to verify_people_are_subset_of_contacts and merge_images_into_contacts.
+    '''
+    cs_by_uid = {}
+    for c in cs:
+        assert c['uid'] not in cs_by_uid, f"UIDs should be unique, but {c['uid']} isn't."
+        cs_by_uid[c['uid']] = c
+    return cs_by_uid, group_by(ims, lambda i: i['base name'])
+
+def verify_people_are_subset_of_contacts(ps,cs,index=None):
+    log.info("START: verify each .abcdp 'person' data (%d) is a sub-dict of 1 db-based contact (%d).", len(ps), len(cs))
     # (This ensures each .abcdp file is accounted for in the db-based contacts.)
-    ps_to_remove = []
+    # The contacts' UIDs are unique (see uid_index), so a peep matches at most 1 contact, but 2 peeps can match the same one.
+    cs_by_uid, _ = index or uid_index(cs)
+    unmatched = [p['uid'] for p in ps if p['uid'] not in cs_by_uid]
+    assert len(unmatched)==0, f"Every peep should match to exactly 1 contact, but {len(unmatched)}/{len(ps)} matched none, eg, {unmatched[:3]}."
+    shared = [u for u,n in Counter(p['uid'] for p in ps).items() if n > 1]
+    assert len(shared)==0, f"Every contact should match at most 1 peep, but {len(shared)} matched more than 1, eg, {shared[:3]}."
     for p in ps:
-        ms = [c for c in cs if c['uid'] == p['uid']]
-        assert len(ms)==1, "Each peep should share a uid with exactly 1 contact."
-        m = ms[0]
-        assert dict_subsetQ(p,m), "The peep's info (k/v pairs) should be a sub-dict of its matching contact."
-        ps_to_remove.append(m)
-    [ps.remove(p) for p in ps_to_remove]
-    assert len(ps)==0, f"Every peep should match to exactly 1 contact, but instead, we have len(ps)={len(ps)}."
-    print(f"Done.")
-
-def merge_images_into_contacts(ims,cs):
+        assert dict_subsetQ(p,cs_by_uid[p['uid']]), "The peep's info (k/v pairs) should be a sub-dict of its matching contact."
+    log.info('Done.')
+
+def merge_images_into_contacts(ims,cs,index=None):
     # for some reason, there are a lot of images that don't map to a contact.
     # there are also a lot of duplicate images.
-    print(f"START: merge {len(ims)} ims into {len(cs)} contacts.")
+    log.info('START: merge %d ims into %d contacts.', len(ims), len(cs))
+
+    cs_by_uid, ims_by_uid = index or uid_index(cs,ims)
 
     for c in cs:
-        imss = [i for i in ims if i['base name'] == c['uid']]
+        imss = ims_by_uid.get(c['uid'])
         if imss:
             c['ims'] = imss
             if len(imss)>1:
-                print(f"Warning: contact \n{pformat(c,indent=4)}\n has {len(imss)} duplicate images: \n{pformat(imss,indent=4)}\n")
+                log.debug('Warning: contact \n%s\n has %d duplicate images: \n%s\n', Pretty(c), len(imss), Pretty(imss))
 
-    orphaned_ims = [i for i in ims if not any(c for c in cs if c['uid']==i['base name'])]
+    orphaned_ims = [i for i in ims if i['base name'] not in cs_by_uid]
 
-    print(f"DONE: merge {len(ims)} ims into {len(cs)} contacts.")
-    print(f"{len([c for c in cs if 'ims' not in c])}/{len(cs)} contacts have no image (expect most cs to have no ims).")
-    print(f"{len([c for c in cs if 'ims' in c and len(c['ims'])>1])}/{len(cs)} contacts have >1 image (dup ims are weird, but happen).")
-    print(f"{len(orphaned_ims)}/{len(ims)} ims are orphaned (common to have orphaned ims bc many duplicates).")
+    log.info('DONE: merge %d ims into %d contacts.', len(ims), len(cs))
+    log.info('%d/%d contacts have no image (expect most cs to have no ims).', sum('ims' not in c for c in cs), len(cs))
+    log.info('%d/%d contacts have >1 image (dup ims are weird, but happen).', sum('ims' in c and len(c['ims'])>1 for c in cs), len(cs))
+    log.info('%d/%d ims are orphaned (common to have orphaned ims bc many duplicates).', len(orphaned_ims), len(ims))
     if len(orphaned_ims)>0:
-        print("Example:")
-        pp(orphaned_ims[0])
+        log.debug('Example:\n%s', Pretty(orphaned_ims[0]))
 
     return orphaned_ims, cs
 
-def actually_copy_and_rename_image_files(cs, outdir):
-    print(f"START: actually_copy_and_rename_image_files of {len(cs)} contacts' images into outdir={outdir}")
-    print(f"Info: # contacts with 'ims': {len([c for c in cs if 'ims' in c and len(c['ims'])>0])}")
-    for c in cs:
-        if 'ims' in c:
-            for i in c['ims']:
-                b = i['base name']
-                ext = i['image type']
-                assert b
-                assert ext
-
-                fbase = '_'.join(
-                        re.sub(r'[^a-zA-Z0-9_-]','',c[k].replace(' ','-')) 
-                        for k in ['first','last','organization'] 
-                        if k in c and re.sub(r'[^a-zA-Z0-9_]','',c[k])
-                        )
-
-                src = i['path']
-                dst = outdir / (fbase + f"__{b}.{ext}")
-
-                # if dst.is_file():
-                #     print(f"Warning: overwriting {dst}")
-
-                n = 1
-                while dst.is_file():
-                    n += 1
-                    dst = outdir / (fbase + f"__{b}__{n}.{ext}")
-
-                i['dst'] = dst
-
-                # copy image files into new dir
-                shutil.copy2(src,dst)
-    print('Done.')
-
-def actually_copy_and_rename_ORPHANED_image_files(ims, outdir):
-    print(f"START: actually_copy_and_rename_ORPHANED_image_files of {len(ims)} contacts' images into outdir={outdir}")
+def modified_sinceQ(c, since):
+    '''Returns True if contact c was modified at or after since (a string from iso_date).'''
+    return c.modified is not None and c.modified >= since
+
+def stream_contacts(base_dir : Path, ps, ims, outdir, jobs=1, store=None, counts=None, since=None):
+    '''Generator: does the work of load_contacts, clean_contacts, verify_people_are_subset_of_contacts,
+    merge_images_into_contacts and actually_copy_and_rename_image_files, but 1 contact at a time,
+    yielding each finished contact (see iter_all_contacts).
+    If given the dict counts, it adds the # of images copied and their bytes to it, like copy_image_files returns.
+    If given since, it skips (doesn't copy or yield) the contacts that weren't modified since then (see modified_sinceQ).
+
+    Once it's exhausted, it checks that every person in ps matched a contact, and
+    removes the claimed images from ims, leaving only the orphaned images.
+    '''
+    log.info('START: stream contacts, verifying against %d people and merging %d ims.', len(ps), len(ims))
+    people = {p['uid']: p for p in ps}
+    assert len(people)==len(ps), f"Every contact should match at most 1 peep, but {len(ps)-len(people)} peeps share a UID with another."
+    ims_by_uid = group_by(ims, lambda i: i['base name'])
+    claimed = set()
+    taken = set()
+    n = 0
+    copied = {'images copied': 0, 'bytes copied': 0}
+    with ThreadPoolExecutor(jobs) as pool:
+        copying = deque()  # copies still in flight, oldest first
+        for c in iter_all_contacts(base_dir):
+            if c['uid'] in people:
+                assert dict_subsetQ(people.pop(c['uid']),c), "The peep's info (k/v pairs) should be a sub-dict of its matching contact."
+            if c['uid'] in ims_by_uid:
+                c['ims'] = ims_by_uid[c['uid']]
+                claimed.add(c['uid'])
+                if len(c['ims'])>1:
+                    log.debug('Warning: contact \n%s\n has %d duplicate images: \n%s\n', Pretty(c), len(c['ims']), Pretty(c['ims']))
+            if since is not None and not modified_sinceQ(c, since):
+                continue
+            for i in name_contact_image_files(c, outdir, taken):
+                copied['images copied'] += 1
+                copied['bytes copied'] += i['path'].stat().st_size
+                copying.append(pool.submit(copy_image_file, i, store))
+                while len(copying) > 2*jobs:
+                    copying.popleft().result()
+            n += 1
+            yield c
+        for f in copying:
+            f.result()
+    assert len(people)==0, f"Every peep should match to exactly 1 contact, but {len(people)} didn't."
+    ims[:] = [i for i in ims if i['base name'] not in claimed]
+    if counts is not None:
+        counts.update(copied)
+    log.info('DONE: streamed %d contacts; %d ims are orphaned.', n, len(ims))
+
+def copy_image_file(i, store=None):
+    '''Copy image i's 'path' to its 'dst', or if store is a dir, store it there and link dst to that (see store_file, link_file).'''
+    if store is None:
+        copy_file(i['path'], i['dst'])
+    else:
+        link_file(store_file(i['path'], store, ext=i['dst'].suffix), i['dst'])
+
+
+# --pipeline: the stages of a batch run, overlapped, with PIPELINE_QUEUE items at most waiting between 2 stages.
+# The dbs are read, and their rows cleaned, PIPELINE_CHUNK records at a time.
+PIPELINE_QUEUE = 8
+PIPELINE_CHUNK = 256
+
+async def run_pipeline(base_dir : Path, out_contacts : Path, outdir : Path, args, counts, index=None, store=None, thumbs_dir=None, features=None):
+    '''Do what a batch run does up to the export (load_people, load_image_files, load_contacts, clean_people, clean_contacts,
+    verify_people_are_subset_of_contacts, merge_images_into_contacts, actually_copy_and_rename_image_files, export_contacts,
+    and export_thumbnails if given thumbs_dir), as tasks that run at the same time, passing their work along through bounded queues:
+
+        read dbs -> rows -> clean & merge -> contacts -> match people & images, name images -> contacts -> export
+                                                                                            -> images -> copy (args.jobs chunks at once)
+        read .abcdp files, read images (needed before contacts can be matched), export thumbnails: on the side
+
+    A full queue makes the stage before it wait (backpressure), so only about PIPELINE_QUEUE chunks are in flight between 2 stages.
+    The blocking work (sqlite, files, cleaning) runs in threads, so it overlaps with the rest.
+
+    The output is the same as the batch run's: contacts come out in the order of their UIDs' first records, like clean_contacts
+    (a contact whose UID has records in more than 1 db waits, along with those after it, until its last record is read),
+    and images are named in that order too.
+    Adds the # of images copied and their bytes to the dict counts, and if given the list features, appends each contact's duplicate_features to it.
+    Returns the # of contacts exported, the # of images, and the orphaned images.
+    '''
+    jobs = max(args.jobs, 1)
+    loop = asyncio.get_running_loop()
+    rows, cleaned, finished, copies = asyncio.Queue(PIPELINE_QUEUE), asyncio.Queue(PIPELINE_QUEUE), asyncio.Queue(PIPELINE_QUEUE), asyncio.Queue(PIPELINE_QUEUE)
+    people = asyncio.ensure_future(asyncio.to_thread(lambda: clean_people(load_people(base_dir, jobs))))
+    images = asyncio.ensure_future(asyncio.to_thread(load_image_files, base_dir, jobs))
+    fs = find_dbs(base_dir)
+
+    async def read():
+        for f in fs:
+            log.info('START: stream contacts from %s', f)
+            it = iter_contact_rows(f, fields=CONTACT_FIELDS, convert=CONTACT_KEY_CONVERTERS)
+            while chunk := await asyncio.to_thread(lambda: list(islice(it, PIPELINE_CHUNK))):
+                await rows.put((f, chunk))
+        await rows.put(None)
+
+    async def clean():
+        left = await asyncio.to_thread(record_counts, fs)
+        pending = OrderedDict()  # uid -> contact, in order of 1st record, until all its records are merged in
+        def step(f, chunk):
+            ready = []
+            for pk,ds in chunk:
+                ds = [clean_contact_row(tag_source(d, f, base_dir)) for d in ds if contact_rowQ(d)]
+                if not ds:
+                    continue
+                for c in ds:
+                    m = pending.get(c.uid)
+                    if m is None:
+                        pending[c.uid] = c
+                    else:
+                        m.merge(c)
+                left[ds[0].uid] -= 1
+                while pending and left[next(iter(pending))] == 0:
+                    ready.append(pending.popitem(last=False)[1])
+            return ready
+        while (x := await rows.get()) is not None:
+            if ready := await asyncio.to_thread(step, *x):
+                await cleaned.put(ready)
+        assert not pending, f'{len(pending)} contacts never got all their records.'
+        await cleaned.put(None)
+
+    async def match():
+        ps, ims = await people, await images
+        people_by_uid = {p['uid']: p for p in ps}
+        assert len(people_by_uid)==len(ps), f"Every contact should match at most 1 peep, but {len(ps)-len(people_by_uid)} peeps share a UID with another."
+        ims_by_uid = group_by(ims, lambda i: i['base name'])
+        taken, claimed = set(), set()
+        while (cs := await cleaned.get()) is not None:
+            done, ims_to_copy = [], []
+            for c in cs:
+                if c['uid'] in people_by_uid:
+                    assert dict_subsetQ(people_by_uid.pop(c['uid']),c), "The peep's info (k/v pairs) should be a sub-dict of its matching contact."
+                if c['uid'] in ims_by_uid:
+                    c['ims'] = ims_by_uid[c['uid']]
+                    claimed.add(c['uid'])
+                if args.modified_since is not None and not modified_sinceQ(c, args.modified_since):
+                    continue
+                ims_to_copy.extend(name_contact_image_files(c, outdir, taken))
+                if features is not None:
+                    features.append(duplicate_features(c))
+                done.append(c)
+            if ims_to_copy:
+                await copies.put(ims_to_copy)
+            await finished.put(done)
+        # Check before the export's end marker, so a failed check means no export, like a batch run.
+        assert len(people_by_uid)==0, f"Every peep should match to exactly 1 contact, but {len(people_by_uid)} didn't."
+        await finished.put(None)
+        for _ in range(jobs):
+            await copies.put(None)
+        return len(ims), [i for i in ims if i['base name'] not in claimed]
+
+    counts.update({'images copied': 0, 'bytes copied': 0})
+    async def copy():
+        while (ims := await copies.get()) is not None:
+            counts['bytes copied'] += await asyncio.to_thread(lambda: sum(copy_image_file(i, store) or i['path'].stat().st_size for i in ims))
+            counts['images copied'] += len(ims)
+
+    # The export runs in a thread, so if another stage fails it has to be told to stop: it checks stop while it waits,
+    # and an exception on finished stops it too. Either way it raises, so its temp files are deleted (see atomic_open, index_writer).
+    stop = threading.Event()
+    def wait_for(coro):
+        f = asyncio.run_coroutine_threadsafe(coro, loop)
+        while True:
+            try:
+                return f.result(timeout=0.1)
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    f.cancel()
+                    raise RuntimeError('Stopped exporting, since another stage of the pipeline failed.')
+    def next_finished():
+        done = wait_for(finished.get())
+        if isinstance(done, BaseException):
+            raise done
+        return done
+    async def rest_done():
+        await asyncio.gather(*copiers, *threads[1:])
+    def export_all():
+        def cs():
+            while (done := next_finished()) is not None:
+                yield from done
+            # Like a batch run, only put the contacts in place once the images & thumbnails are, too.
+            wait_for(rest_done())
+        return export_contacts(cs(), out_contacts, args.jsonl, index)
+
+    stages = [asyncio.ensure_future(x) for x in (read(), clean(), match())]
+    copiers = [asyncio.ensure_future(copy()) for _ in range(jobs)]
+    threads = []
+    if thumbs_dir is not None:
+        threads.append(asyncio.ensure_future(asyncio.to_thread(export_thumbnails, base_dir, thumbs_dir)))
+    threads.insert(0, asyncio.ensure_future(asyncio.to_thread(export_all)))
+    tasks = stages + copiers + threads
+    try:
+        # Wait for them all at once, so the 1st to fail, whichever it is, stops the rest.
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        failed = [t for t in tasks if t.done() and not t.cancelled() and t.exception() is not None]
+        if failed:
+            raise failed[0].exception()
+    except BaseException as e:
+        # Stop every stage, and wait for the threads to finish, so nothing is left running or half-written.
+        stop.set()
+        for t in stages + copiers + [people, images]:
+            t.cancel()
+        try:
+            finished.put_nowait(RuntimeError(f'Stopped exporting, since another stage of the pipeline failed: {e!r}'))
+        except asyncio.QueueFull:
+            pass
+        await asyncio.gather(*tasks, people, images, return_exceptions=True)
+        raise
+    n_ims, orphaned_ims = stages[2].result()
+    n_cs, *rest = [t.result() for t in threads]
+    if thumbs_dir is not None:
+        counts.update({'thumbnails': rest[-1]['thumbnails'], 'thumbnail bytes': rest[-1]['bytes copied']})
+    counts.update({'contacts': n_cs, 'images': n_ims})
+    log.info('DONE: pipeline: %d contacts; %d ims are orphaned.', n_cs, len(orphaned_ims))
+    return n_cs, n_ims, orphaned_ims
+
+def actually_copy_and_rename_image_files(cs, outdir, jobs=1, manifest=None, prev_images={}, store=None):
+    log.info("START: actually_copy_and_rename_image_files of %d contacts' images into outdir=%s", len(cs), outdir)
+    log.info("Info: # contacts with 'ims': %d", sum('ims' in c and len(c['ims'])>0 for c in cs))
+    # Pick all the file names first, in order, so the __2, __3, ... suffixes don't depend on which copy finishes first.
+    # The files the last incremental run made don't count as taken: we're about to redo them.
+    taken = set()
+    ours = {e['dst'] for e in prev_images.values() if 'dst' in e}
+    ims = [i for c in cs for i in name_contact_image_files(c, outdir, taken, ours)]
+    n = copy_image_files(ims, jobs, manifest, prev_images, store)
+    log.info('Done.')
+    return n
+
+def copy_image_files(ims, jobs=1, manifest=None, prev_images={}, store=None):
+    '''Copy each image's 'path' to its 'dst', with 'jobs' threads at once.
+    For an incremental run, skip the images that the last run already copied to the same dst
+    (per prev_images, its manifest['images']) and whose contents haven't changed since, and record each dst in the manifest.
+    If store is a dir, copy each distinct image (by contents) into it just once, and hard link the dsts to those copies
+    (see store_file, link_file).
+    Returns the # of images copied (or linked) and the # of bytes copied, eg, {'images copied': 10, 'bytes copied': 123456}.
+    '''
+    if manifest is not None:
+        todo = []
+        for i in ims:
+            e, p = manifest['images'][str(i['path'])], prev_images.get(str(i['path']), {})
+            if not (p.get('sha256') == e['sha256'] and p.get('dst') == str(i['dst']) and i['dst'].is_file()):
+                todo.append(i)
+            e['dst'] = str(i['dst'])
+        log.info('Skipping %d/%d images that are unchanged since the last run.', len(ims)-len(todo), len(ims))
+        ims = todo
+    if store is None:
+        # copy image files into new dir
+        pmap(lambda i: copy_file(i['path'],i['dst']), ims, jobs)
+        return {'images copied': len(ims), 'bytes copied': sum(i['path'].stat().st_size for i in ims)}
+    # Store 1 copy of each distinct image, hashing each as it's stored (or looking its hash up in this run's manifest), then link.
+    # (store_file opens each image once, to both hash and copy it.)
+    if manifest is not None:
+        hs = [manifest['images'][str(i['path'])]['sha256'] for i in ims]
+    else:
+        hs = [None] * len(ims)
+    blobs = pmap(lambda ih: store_file(ih[0]['path'], store, ih[1], ih[0]['dst'].suffix), list(zip(ims,hs)), jobs)
+    pmap(lambda ib: link_file(ib[1], ib[0]['dst']), list(zip(ims,blobs)), jobs)
+    firsts = {b: i for i,b in reversed(list(zip(ims,blobs)))}
+    log.info('%d images are %d distinct images, stored in %s.', len(ims), len(firsts), store)
+    return {'images copied': len(ims), 'distinct images': len(firsts), 'bytes copied': sum(i['path'].stat().st_size for i in firsts.values())}
+
+def prune_image_store(store):
+    '''Delete the files in store that no image links to anymore (see copy_image_files).'''
+    n = 0
+    for f in store.iterdir():
+        if f.stat().st_nlink == 1:
+            f.unlink()
+            n += 1
+    log.info('Removed %d unused files from %s.', n, store)
+
+def remove_stale_outputs(manifest, prev_images):
+    '''Delete the image copies the last incremental run made that this run didn't (eg, for deleted or renamed contacts).'''
+    stale = {e['dst'] for e in prev_images.values() if 'dst' in e} - {e['dst'] for e in manifest['images'].values() if 'dst' in e}
+    for f in stale:
+        Path(f).unlink(missing_ok=True)
+    log.info('Removed %d stale image files from the last run.', len(stale))
+
+def name_contact_image_files(c, outdir, taken, ours=()):
+    '''Set 'dst' of each of contact c's images to a new file in outdir named after the contact, eg,
+    'Apple-Inc__C13384AC-D081-4190-B5CB-DAEEE889A64D.tiff', or '...__2.tiff', '...__3.tiff', ...
+    if that file already exists or is in the set 'taken' (of dsts picked but not copied yet).
+    Existing files in 'ours' (str paths) don't count: the caller will overwrite them.
+    Returns c's images.
+    '''
+    if 'ims' not in c:
+        return []
+    for i in c['ims']:
+        b = i['base name']
+        ext = i['image type']
+        assert b
+        assert ext
+
+        fbase = '_'.join(
+                re.sub(r'[^a-zA-Z0-9_-]','',c[k].replace(' ','-')) 
+                for k in ['first','last','organization'] 
+                if k in c and re.sub(r'[^a-zA-Z0-9_]','',c[k])
+                )
+
+        dst = outdir / (fbase + f"__{b}.{ext}")
+
+        # if dst.is_file():
+        #     log.warning('Warning: overwriting %s', dst)
+
+        n = 1
+        while dst in taken or (dst.is_file() and str(dst) not in ours):
+            n += 1
+            dst = outdir / (fbase + f"__{b}__{n}.{ext}")
+
+        taken.add(dst)
+        i['dst'] = dst
+    return c['ims']
+
+def actually_copy_and_rename_ORPHANED_image_files(ims, outdir, jobs=1, manifest=None, prev_images={}, store=None):
+    log.info("START: actually_copy_and_rename_ORPHANED_image_files of %d contacts' images into outdir=%s", len(ims), outdir)
+    dsts = {}
     for i in ims:
         b = i['base name']
         ext = i['image type']
         assert b
         assert ext
-        shutil.copy2(
-            i['path'],
-            outdir / f"{b}.{ext}"
-            )
-    print('Done.')
+        dsts[outdir / f"{b}.{ext}"] = i['path']  # If 2 ims get the same name, the last one wins, like it would copying 1 by 1.
+    n = copy_image_files([{'path': src, 'dst': dst} for dst,src in dsts.items()], jobs, manifest, prev_images, store)
+    log.info('Done.')
+    return n
+
+
+# The file exts that export_thumbnails gives thumbnails: their image types (see lib.sniff_header), or 'bin' if it can't tell.
+THUMBNAIL_EXTS = frozenset(['jpeg','png','gif','tiff','heic','bin'])
+
+def export_thumbnails(base_dir : Path, outdir : Path):
+    '''Save each record's thumbnail (ZABCDRECORD.ZTHUMBNAILIMAGEDATA) in the .abcddb dbs in base_dir
+    to outdir/<uid>.<ext> (or <uid>__2.<ext>, ... if a UID has more than 1), replacing the thumbnails there
+    (files with an ext it writes, see THUMBNAIL_EXTS; anything else in outdir is left alone).
+    Each one goes straight from the db to its file, a chunk at a time (see copy_blob); the main query
+    never selects them (see CONTACT_FIELDS), so without --thumbnails they're never read at all.
+
+    Core Data may start the blob with a marker byte: 1 means the image data follows, and 2 means the image
+    is in a file next to the db, in '.AddressBook-v22_SUPPORT/_EXTERNAL_DATA/', named by the rest of the blob.
+    Returns the # of thumbnails saved and their bytes, eg, {'thumbnails': 20, 'bytes copied': 123456}.
+    '''
+    log.info('START: export thumbnails into outdir=%s', outdir)
+    for f in outdir.iterdir():
+        if f.suffix[1:] in THUMBNAIL_EXTS and f.is_file():
+            f.unlink()
+    n = {'thumbnails': 0, 'bytes copied': 0}
+    taken = set()
+    for db in find_dbs(base_dir):
+        if not table_has_columnQ('ZABCDRECORD','ZTHUMBNAILIMAGEDATA',db):
+            continue
+        for rowid, uid, size in iter_blobs('ZABCDRECORD','ZTHUMBNAILIMAGEDATA',db):
+            h = read_blob('ZABCDRECORD','ZTHUMBNAILIMAGEDATA',rowid,db,128)
+            src, skip = None, 0
+            if h[:1] == b'\x02':
+                src = db.parent / f'.{db.stem}_SUPPORT' / '_EXTERNAL_DATA' / h[1:].split(b'\0')[0].decode(errors='replace')
+                if not src.is_file():
+                    log.warning("Warning: record %s's thumbnail is in file %s, which isn't there; skipping it.", uid, src)
+                    continue
+                ext = sniff(src)[1] or 'bin'
+            else:
+                skip = 1 if h[:1] == b'\x01' else 0
+                ext = sniff_header(h[skip:])[1] or 'bin'
+
+            b = (uid or f'record-{rowid}').replace(':ABPerson','').replace(':','_')
+            dst, i = outdir / f'{b}.{ext}', 1
+            while dst in taken:
+                i += 1
+                dst = outdir / f'{b}__{i}.{ext}'
+            taken.add(dst)
+
+            if src is None:
+                n['bytes copied'] += copy_blob('ZABCDRECORD','ZTHUMBNAILIMAGEDATA',rowid,db,dst,skip)
+            else:
+                shutil.copyfile(src, dst)
+                n['bytes copied'] += dst.stat().st_size
+            n['thumbnails'] += 1
+    log.info('Done: saved %d thumbnails (%d bytes).', n['thumbnails'], n['bytes copied'])
+    return n
 
 
 #################################################################################################
@@ -0,0 +1,101 @@
+from pathlib import Path
+import argparse, json, re
+from lib import schema, phone_digits, normalize_email, iso_date, INDEX_VERSION
+
+# Look up contacts in the search index that main.py --index writes ('out/contacts.db'),
+# by name, organization or note (full-text), email, phone or UID. See README.md for details.
+
+def search(db, text, limit=20):
+    '''Returns the contacts whose names, organization or note have all the words in text (as word prefixes,
+    ignoring case and accents), best matches first, eg, search(db, 'ann o') finds "Ann Marie O'Neil".
+    '''
+    ws = re.findall(r'\w+', text)
+    if not ws:
+        return []
+    q = ' '.join('"' + w + '"*' for w in ws)
+    return contacts(db, [r[0] for r in con(db).execute('SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH ? ORDER BY rank LIMIT ?', (q, limit))])
+
+def by_email(db, email):
+    '''Returns the contacts with the given email address (ignoring case).'''
+    return contacts(db, [r[0] for r in con(db).execute('SELECT DISTINCT contact FROM emails WHERE normalized = ? ORDER BY contact', (normalize_email(email),))])
+
+def by_phone(db, phone, min_digits=7):
+    '''Returns the contacts with the given phone number, comparing just the digits, eg, '(123) 123-1234' finds '+1-123-123-1234'.
+    Numbers of at least min_digits digits also match if one ends with the other, so a missing country code or area code doesn't matter.
+    '''
+    d = phone_digits(phone)
+    if not d:
+        return []
+    if len(d) < min_digits:
+        q, params = 'digits = ?', [d]
+    else:
+        # Stored reversed too, so "ends with" is a prefix match, which the index can do.
+        r = d[::-1]
+        shorter = [r[:k] for k in range(min_digits, len(r))]
+        q, params = f"rdigits GLOB ? OR rdigits IN ({','.join('?'*len(shorter))})", [r + '*'] + shorter
+    return contacts(db, [r[0] for r in con(db).execute(f'SELECT DISTINCT contact FROM phones WHERE {q} ORDER BY contact', params)])
+
+def by_uid(db, uid):
+    '''Returns the contact with the given UID, in a list (or an empty list).'''
+    return contacts(db, [r[0] for r in con(db).execute('SELECT id FROM contacts WHERE uid = ?', (uid,))])
+
+def modified_since(db, since):
+    '''Returns the contacts modified at or after since, eg, '2023-03-08T20:26:40+00:00' (see lib.iso_date), oldest first.'''
+    return contacts(db, [r[0] for r in con(db).execute('SELECT id FROM contacts WHERE modified >= ? ORDER BY modified, id', (since,))])
+
+def contacts(db, ids):
+    '''Returns the contacts with the given ids (the contacts table's), as the dicts in contacts.json, in the order of ids.'''
+    if not ids:
+        return []
+    js = dict(con(db).execute(f"SELECT id, json FROM contacts WHERE id IN ({','.join('?'*len(ids))})", ids))
+    return [json.loads(js[i]) for i in ids]
+
+def con(db):
+    '''The (read-only, cached) connection to search index db, after checking that it's one this code can read.'''
+    c = schema(db).con
+    v = dict(c.execute('SELECT key, value FROM meta')).get('version')
+    assert v == INDEX_VERSION, f'Expected search index {db} to be version {INDEX_VERSION}, but it is {v}. Re-run main.py --index.'
+    return c
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up contacts in the search index from main.py --index. See README.md for details.")
+    parser.add_argument('text', nargs='?', default=None,
+        help='Find contacts whose names, organization or note have these words (or words starting with them).')
+    parser.add_argument('--db', type=Path, default=Path('out/contacts.db'),
+        help='The search index to query. (default: out/contacts.db)')
+    g = parser.add_mutually_exclusive_group()
+    g.add_argument('--email', help='Find contacts with this email address.')
+    g.add_argument('--phone', help='Find contacts with this phone number (just the digits count).')
+    g.add_argument('--uid', help='Find the contact with this UID.')
+    g.add_argument('--modified-since', type=iso_date, metavar='DATE', help="Find the contacts modified at or after DATE, eg, '2023-03-08' (UTC if no time zone).")
+    parser.add_argument('--limit', type=int, default=20, help='Return at most this many full-text matches. (default: 20)')
+    parser.add_argument('--jsonl', action='store_true', help='Print 1 contact per line, instead of a json list.')
+    args = parser.parse_args()
+    lookups = [k for k in ['text','email','phone','uid','modified_since'] if getattr(args,k) is not None]
+    if len(lookups) != 1:
+        parser.error('Give exactly 1 of: some text, --email, --phone, --uid, --modified-since.')
+    if not args.db.is_file():
+        parser.error(f'No search index {args.db}; make one with: python main.py --index')
+
+    if args.email is not None:
+        cs = by_email(args.db, args.email)
+    elif args.phone is not None:
+        cs = by_phone(args.db, args.phone)
+    elif args.uid is not None:
+        cs = by_uid(args.db, args.uid)
+    elif args.modified_since is not None:
+        cs = modified_since(args.db, args.modified_since)
+    else:
+        cs = search(args.db, args.text, args.limit)
+
+    if args.jsonl:
+        for c in cs:
+            print(json.dumps(c))
+    else:
+        print(json.dumps(cs, indent=4))
+    return len(cs) > 0
+
+
+if __name__=='__main__':
+    raise SystemExit(0 if main() else 1)
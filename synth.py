@@ -0,0 +1,195 @@
+from pathlib import Path
+import argparse, plistlib, random, sqlite3, struct, uuid, zlib
+
+# Make a fake Mac Address Book file (.abbu) full of made-up contacts, for testing and benchmarking
+# (see bench.py), since the real ones are full of real people's info. See README.md for details.
+#
+# The dbs have the same tables & columns as a real 'AddressBook-v22.abcddb' (the ones this program reads, anyway),
+# and the .abcdp files and Images/ look like real ones too. The same args (incl. seed) make the same .abbu file.
+
+def main():
+    parser = argparse.ArgumentParser(description='Make a fake .abbu file full of made-up contacts, for testing and benchmarking.')
+    parser.add_argument('dir', type=Path, help="The .abbu dir to make, eg, 'in/Fake.abbu'. Must not exist yet.")
+    parser.add_argument('--contacts', '-n', type=int, default=1000, help='# of contacts in each db. (default: 1000)')
+    parser.add_argument('--sources', type=int, default=1, help="# of extra dbs under 'Sources/', like 1 per account. (default: 1)")
+    parser.add_argument('--seed', type=int, default=0, help='Random seed. (default: 0)')
+    parser.add_argument('--phones', type=int, default=3, metavar='N', help='Each contact gets 0 to N phone numbers. (default: 3)')
+    parser.add_argument('--emails', type=int, default=3, metavar='N', help='Each contact gets 0 to N email addresses. (default: 3)')
+    parser.add_argument('--urls', type=int, default=2, metavar='N', help='Each contact gets 0 to N urls. (default: 2)')
+    parser.add_argument('--addresses', type=int, default=2, metavar='N', help='Each contact gets 0 to N postal addresses. (default: 2)')
+    parser.add_argument('--people-ratio', type=float, default=0.4, metavar='R', help='Fraction of contacts that get a .abcdp file. (default: 0.4)')
+    parser.add_argument('--image-ratio', type=float, default=0.3, metavar='R', help='Fraction of contacts that get an image. (default: 0.3)')
+    parser.add_argument('--dup-image-ratio', type=float, default=0.2, metavar='R', help='Fraction of images that are byte-for-byte copies of an earlier image. (default: 0.2)')
+    parser.add_argument('--orphan-ratio', type=float, default=0.1, metavar='R', help='# of orphaned images (named after no contact), per contact. (default: 0.1)')
+    parser.add_argument('--image-bytes', type=int, default=4096, metavar='N', help='Rough size of each image file. (default: 4096)')
+    args = parser.parse_args()
+    make_abbu(args.dir, **{k: v for k,v in vars(args).items() if k != 'dir'})
+    print(f'Made {args.dir}')
+
+
+def make_abbu(d, contacts=1000, sources=1, seed=0, phones=3, emails=3, urls=2, addresses=2,
+              people_ratio=0.4, image_ratio=0.3, dup_image_ratio=0.2, orphan_ratio=0.1, image_bytes=4096):
+    '''Make a fake .abbu dir d: a root db plus 'sources' dbs under Sources/<uuid>/,
+    each with 'contacts' contacts, and its own Metadata/ (.abcdp files) and Images/ dirs.
+    Returns the # of contacts, .abcdp files and image files made.
+    '''
+    rng = random.Random(seed)
+    d = Path(d)
+    (d / 'Metadata').mkdir(parents=True)
+    (d / 'Sources').mkdir()
+    dirs = [d] + [d / 'Sources' / new_uid(rng) for _ in range(sources)]
+    counts = {'contacts': 0, 'people': 0, 'images': 0}
+    ims = [] # the images made so far, to copy for duplicates
+    for sd in dirs:
+        (sd / 'Metadata').mkdir(parents=True, exist_ok=True)
+        (sd / 'Images').mkdir()
+        people = make_abcddb(sd / 'AddressBook-v22.abcddb', rng, contacts, phones, emails, urls, addresses, people_ratio)
+        counts['contacts'] += len(people)
+        for uid,p in people:
+            if p is not None:
+                with open(sd / 'Metadata' / f'{uid}:ABPerson.abcdp', 'wb') as fh:
+                    plistlib.dump(p, fh, fmt=plistlib.FMT_BINARY)
+                counts['people'] += 1
+        names = [uid for uid,_ in people if rng.random() < image_ratio]
+        names += [uid + '.jpeg' for uid in names if rng.random() < 0.1] # Some contacts have 2 images.
+        names += [new_uid(rng) for _ in range(round(orphan_ratio * contacts))]
+        for name in names:
+            if ims and rng.random() < dup_image_ratio:
+                im = rng.choice(ims)
+            else:
+                im = make_image(rng, image_bytes)
+                ims.append(im)
+            (sd / 'Images' / name).write_bytes(im)
+        counts['images'] += len(names)
+    return counts
+
+
+def new_uid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128))).upper()
+
+def make_image(rng, size):
+    '''Random bytes, with a JPEG, PNG or TIFF header.'''
+    t = rng.choice(['jpeg','jpeg','png','tiff'])
+    if t == 'jpeg':
+        return b'\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00' + rng.randbytes(size) + b'\xff\xd9'
+    if t == 'png':
+        ihdr = struct.pack('>IIBBBBB', rng.randrange(16,1024), rng.randrange(16,1024), 8, 2, 0, 0, 0)
+        return b'\x89PNG\r\n\x1a\n' + struct.pack('>I',13) + b'IHDR' + ihdr + struct.pack('>I', zlib.crc32(b'IHDR'+ihdr)) + rng.randbytes(size)
+    return b'MM\x00*\x00\x00\x00\x08' + rng.randbytes(size)
+
+
+##################################################
+# The db
+##################################################
+
+# The tables & columns of a real 'AddressBook-v22.abcddb' that matter here.
+# (A real one has ~40 tables. The rest don't have a ZOWNER or ZCONTACT column, so they aren't joined anyway.)
+TABLES = {
+    'ZABCDRECORD': ['Z_PK','Z_ENT','Z_OPT','ZCONTACTINDEX','ZDISPLAYFLAGS','ZIOSLEGACYIDENTIFIER','ZSYNCSTATUS','ZLINKID',
+                    'ZCONTAINER1','ZCONTAINERWHERECONTACTISME','ZSOURCEWHERECONTACTISME','ZCREATIONDATEYEAR','ZCREATIONDATEYEARLESS',
+                    'ZMODIFICATIONDATEYEAR','ZMODIFICATIONDATEYEARLESS','ZPREFERREDFORLINKNAME','ZPREFERREDFORLINKPHOTO',
+                    'ZCREATIONDATE','ZMODIFICATIONDATE','ZBIRTHDAY','ZUNIQUEID','ZEXTERNALCOLLECTIONPATH','ZEXTERNALFILENAME','ZEXTERNALHASH',
+                    'ZEXTERNALMODIFICATIONTAG','ZEXTERNALUUID','ZFIRSTNAME','ZLASTNAME','ZMIDDLENAME','ZNICKNAME','ZORGANIZATION','ZJOBTITLE',
+                    'ZNAME','ZNOTE','ZSORTINGFIRSTNAME','ZSORTINGLASTNAME','ZTHUMBNAILIMAGEDATA'],
+    'ZABCDPHONENUMBER': ['Z_PK','Z_ENT','Z_OPT','ZISPRIMARY','ZORDERINGINDEX','ZOWNER','Z21_OWNER','Z22_OWNER',
+                         'ZFULLNUMBER','ZLABEL','ZLASTFOURDIGITS','ZIOSLEGACYIDENTIFIER','ZUNIQUEID'],
+    'ZABCDEMAILADDRESS': ['Z_PK','Z_ENT','Z_OPT','ZISPRIMARY','ZORDERINGINDEX','ZOWNER','Z21_OWNER','Z22_OWNER',
+                          'ZADDRESS','ZADDRESSNORMALIZED','ZLABEL','ZUNIQUEID'],
+    'ZABCDURLADDRESS': ['Z_PK','Z_ENT','Z_OPT','ZISPRIMARY','ZOWNER','Z21_OWNER','Z22_OWNER','ZLABEL','ZURL','ZUNIQUEID'],
+    'ZABCDPOSTALADDRESS': ['Z_PK','Z_ENT','Z_OPT','ZISPRIMARY','ZOWNER','Z21_OWNER','Z22_OWNER','ZCITY','ZCOUNTRYCODE',
+                           'ZCOUNTRYNAME','ZLABEL','ZSTATE','ZSTREET','ZUNIQUEID','ZZIPCODE'],
+    'ZABCDNOTE': ['Z_PK','Z_ENT','Z_OPT','ZCONTACT','Z22_CONTACT','ZTEXT'],
+    'ZABCDCONTACTINDEX': ['Z_PK','Z_ENT','Z_OPT','ZCONTACT','Z21_CONTACT','Z22_CONTACT','ZSTRINGFORINDEXING'],
+    'Z_PRIMARYKEY': ['Z_ENT','Z_NAME','Z_SUPER','Z_MAX'],
+    'Z_METADATA': ['Z_VERSION','Z_UUID','Z_PLIST'],
+}
+
+LABELS = ['_$!<Mobile>!$_','_$!<Home>!$_','_$!<Work>!$_','_$!<Main>!$_','iPhone','_$!<Other>!$_']
+FIRSTS = ['bob','Alice','Ann Marie','José','Zoë','李',None]
+LASTS = ['johnson','Smith',"O'Neil",'van der Berg',None]
+ORGS = [None,None,'acme corp','Apple Inc.']
+CITIES = [('Cupertino','CA','95014','United States','us'), ('Toronto','ON','M5V 2T6','Canada','ca'), ('Paris',None,'75001','France','fr')]
+
+def make_abcddb(db, rng, n, phones, emails, urls, addresses, people_ratio):
+    '''Make a fake sqlite db 'AddressBook-v22.abcddb' with n contacts (plus a group and an info record, like real ones).
+    Returns a (uid, .abcdp dict or None) pair for each contact.
+    The .abcdp dict holds a subset of the contact's info in the db, like a real .abcdp file.
+    '''
+    con = sqlite3.connect(db)
+    for t,cs in TABLES.items():
+        con.execute(f"CREATE TABLE {t} ({', '.join(c + (' INTEGER PRIMARY KEY' if c == cs[0] else '') for c in cs)})")
+    for t in TABLES:
+        for c in ['ZOWNER','ZCONTACT']:
+            if c in TABLES[t]:
+                con.execute(f'CREATE INDEX {t}_{c}_INDEX ON {t} ({c})')
+
+    rows = {t: [] for t in TABLES} # table -> list of dicts, inserted at the end
+    rows['ZABCDRECORD'] += [{'Z_PK': 1, 'Z_ENT': 19, 'ZUNIQUEID': new_uid(rng) + ':ABGroup', 'ZNAME': 'Friends'},
+                            {'Z_PK': 2, 'Z_ENT': 15, 'ZUNIQUEID': new_uid(rng) + ':ABInfo'}]
+    people = []
+    for pk in range(3, n+3):
+        uid = new_uid(rng)
+        first, last, org = rng.choice(FIRSTS), rng.choice(LASTS), rng.choice(ORGS)
+        if not (first or last or org):
+            first = 'x'
+        has_plist = rng.random() < people_ratio
+        rows['ZABCDRECORD'].append({
+            'Z_PK': pk, 'Z_ENT': 22, 'Z_OPT': rng.randrange(1,9), 'ZCONTACTINDEX': pk, 'ZCONTAINER1': 1, 'ZDISPLAYFLAGS': 0,
+            'ZCREATIONDATE': rng.uniform(3e8,7e8), 'ZMODIFICATIONDATE': rng.uniform(7e8,7.5e8),
+            'ZBIRTHDAY': None if has_plist else rng.choice([None, None, rng.uniform(-1e9,1e8)]),
+            'ZUNIQUEID': uid + ':ABPerson', 'ZFIRSTNAME': first, 'ZLASTNAME': last, 'ZORGANIZATION': org,
+            'ZNICKNAME': None if has_plist else rng.choice([None,None,None,'Bobby']),
+            'ZSORTINGFIRSTNAME': (first or '').lower(), 'ZSORTINGLASTNAME': (last or '').lower(),
+            'ZTHUMBNAILIMAGEDATA': make_image(rng, 256) if rng.random() < 0.2 else None})
+        p = {'UID': uid + ':ABPerson', 'Creation': 'x', 'Modification': 'y', 'ABPersonFlags': 0, 'com.apple.uuid': new_uid(rng)}
+        for k,v in [('First',first),('Last',last),('Organization',org)]:
+            if v:
+                p[k] = v
+
+        for t, ent, col, k, m, mk in [
+            ('ZABCDPHONENUMBER', 13, 'ZFULLNUMBER', 'Phone', phones, lambda: f'{rng.randrange(100,999)}-{rng.randrange(100,999)}-{rng.randrange(1000,9999)}'),
+            ('ZABCDEMAILADDRESS', 8, 'ZADDRESS', 'Email', emails, lambda: f'u{rng.randrange(10**6)}@Example.com'),
+            ('ZABCDURLADDRESS', 25, 'ZURL', 'URLs', urls, lambda: f'http://example.com/{rng.randrange(10**6)}')]:
+            vals = list(dict.fromkeys((rng.choice(LABELS), mk()) for _ in range(rng.randint(0,m)))) # no exact dups, like real contacts
+            for j,(lab,v) in enumerate(vals):
+                r = {'Z_ENT': ent, 'Z_OPT': 1, 'ZISPRIMARY': int(j==0), 'ZOWNER': pk, 'Z22_OWNER': 22, col: v, 'ZLABEL': lab, 'ZUNIQUEID': str(uuid.UUID(int=rng.getrandbits(128)))}
+                if t == 'ZABCDPHONENUMBER':
+                    r.update({'ZORDERINGINDEX': j, 'ZLASTFOURDIGITS': v[-4:]})
+                elif t == 'ZABCDEMAILADDRESS':
+                    r.update({'ZORDERINGINDEX': j, 'ZADDRESSNORMALIZED': v.lower()})
+                rows[t].append(r)
+            if vals:
+                p[k] = {'labels': [l for l,_ in vals], 'values': [v for _,v in vals], 'identifiers': ['x']*len(vals), 'primary': 'x'}
+
+        addrs = []
+        for j in range(rng.randint(0,addresses)):
+            city, state, zip, country, code = rng.choice(CITIES)
+            a = {'Street': f'{rng.randrange(1,999)} Main St', 'City': city, 'State': state, 'ZIP': zip, 'Country': country, 'CountryCode': code}
+            a = {k: v for k,v in a.items() if v is not None}
+            lab = rng.choice(LABELS)
+            if (lab,a) in addrs:
+                continue
+            rows['ZABCDPOSTALADDRESS'].append({'Z_ENT': 10, 'Z_OPT': 1, 'ZISPRIMARY': int(j==0), 'ZOWNER': pk, 'Z22_OWNER': 22,
+                'ZCITY': city, 'ZCOUNTRYCODE': code, 'ZCOUNTRYNAME': country, 'ZLABEL': lab, 'ZSTATE': state,
+                'ZSTREET': a['Street'], 'ZUNIQUEID': str(uuid.UUID(int=rng.getrandbits(128))), 'ZZIPCODE': zip})
+            addrs.append((lab,a))
+        if addrs:
+            p['Address'] = {'labels': [l for l,_ in addrs], 'values': [a for _,a in addrs], 'identifiers': ['x']*len(addrs), 'primary': 'x'}
+
+        if not has_plist and rng.random() < 0.2:
+            rows['ZABCDNOTE'].append({'Z_ENT': 9, 'Z_OPT': 1, 'ZCONTACT': pk, 'Z22_CONTACT': 22, 'ZTEXT': 'likes cats'})
+        rows['ZABCDCONTACTINDEX'].append({'Z_ENT': 5, 'Z_OPT': 1, 'ZCONTACT': pk, 'Z22_CONTACT': 22,
+                                          'ZSTRINGFORINDEXING': ' '.join(x for x in [first,last,org] if x)})
+        people.append((uid, p if has_plist else None))
+
+    for t,rs in rows.items():
+        for cols in dict.fromkeys(tuple(r) for r in rs): # insert the rows that have the same columns together
+            con.executemany(f"INSERT INTO {t} ({','.join(cols)}) VALUES ({','.join('?'*len(cols))})",
+                            [tuple(r.values()) for r in rs if tuple(r) == cols])
+    con.commit()
+    con.close()
+    return people
+
+
+if __name__=='__main__':
+    main()
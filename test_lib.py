@@ -0,0 +1,31 @@
+from lib import sniff_header, duplicate_features, find_duplicates, diff_contact
+
+# Run with: python -m pytest -q
+
+
+def test_sniff_header_truncated():
+    '''Headers too short for the details give just the format, not an error.'''
+    png = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x01@\x00\x00\x01@\x08\x06\x00\x00\x00'
+    assert sniff_header(png) == ('PNG image data, 320 x 320, 8-bit/color RGBA, non-interlaced\n', 'png')
+    for h, want in [(png[:20], ('PNG image data\n', 'png')),
+                    (b'\xff\xd8\xff\xe0\x00\x10JFIF', ('JPEG image data\n', 'jpeg')),
+                    (b'GIF89a\x01', ('GIF image data, version 89a\n', 'gif')),
+                    (b'SQLite format 3\x00' + bytes(20), ('SQLite 3.x database\n', None)),
+                    (b'', ('empty\n', None))]:
+        assert sniff_header(h) == want
+
+
+def test_find_duplicates_family_landline():
+    '''A family sharing a landline isn't 1 person, but a nickname or an initial on the same number is.'''
+    def contact(uid, first, last):
+        return {'uid': uid, 'first': first, 'last': last, 'phone': [('Home', '(416) 555-0101')]}
+    cs = [contact('1', 'Bob', 'Jones'), contact('2', 'Mary', 'Jones'), contact('3', 'Robert', 'Jones'), contact('4', 'M.', 'Jones'), contact('5', 'Tim', 'Jones')]
+    r = find_duplicates(map(duplicate_features, cs))
+    assert sorted(sorted(c['uids']) for c in r['clusters']) == [['1', '3'], ['2', '4']]
+
+
+def test_diff_contact_counts_repeats():
+    '''Lists are compared as multisets: order doesn't matter, but a repeated value does.'''
+    a = {'uid': '1', 'phone': [['Home', '123'], ['Work', '456']]}
+    assert diff_contact(a, {'uid': '1', 'phone': [['Work', '456'], ['Home', '123']]}) == {}
+    assert diff_contact(a, {'uid': '1', 'phone': [['Home', '123'], ['Work', '456'], ['Home', '123']]}) == {'phone': {'added': [['Home', '123']], 'removed': []}}
@@ -0,0 +1,59 @@
+from pathlib import Path
+import os, plistlib, subprocess, sys
+import pytest
+import synth
+
+# Run with: python -m pytest -q
+
+HERE = Path(__file__).resolve().parent
+
+
+def test_pipeline_stops_when_a_stage_fails(tmp_path):
+    '''A peep that doesn't match its contact fails the match stage: --pipeline should exit with that error, not hang,
+    and leave no export or temp files behind.'''
+    synth.make_abbu(tmp_path / 'in' / 'X.abbu', contacts=2000, seed=1, image_ratio=0.1)
+    fs = sorted((tmp_path / 'in' / 'X.abbu' / 'Metadata').glob('*.abcdp'))
+    f = fs[len(fs) // 2]
+    p = plistlib.loads(f.read_bytes())
+    p['First'] = 'Not ' + p.get('First', '')
+    f.write_bytes(plistlib.dumps(p))
+    (tmp_path / 'out').mkdir()
+
+    r = subprocess.run([sys.executable, HERE / 'main.py', '-q', '--pipeline', '--index'], cwd=tmp_path, capture_output=True, text=True, timeout=120)
+    assert r.returncode != 0
+    assert 'AssertionError' in r.stderr
+    assert not (tmp_path / 'out' / 'contacts.json').exists()
+    assert not (tmp_path / 'out' / 'contacts.db').exists()
+    assert list((tmp_path / 'out').glob('.*.tmp')) == []
+
+
+# Run main.py with a func of it replaced by one that fails on its nth call.
+FAIL_ON_NTH_CALL = '''
+import sys, main
+name, n = sys.argv[1], int(sys.argv[2])
+owner = main.Contact if name == 'as_dict' else main
+f, calls = getattr(owner, name), []
+def failing(*args):
+    calls.append(1)
+    if len(calls) == n:
+        raise OSError(f'{name} failed')
+    return f(*args)
+setattr(owner, name, failing)
+sys.argv[1:] = sys.argv[3:]
+main.main()
+'''
+
+@pytest.mark.parametrize('name, n', [('as_dict', 5), ('export_thumbnails', 1)])
+def test_pipeline_stops_when_the_export_fails(tmp_path, name, n):
+    '''If the export or the thumbnails fail, --pipeline should stop the other stages and exit with that error, not hang,
+    and leave no export or temp files behind, like a batch run.'''
+    synth.make_abbu(tmp_path / 'in' / 'X.abbu', contacts=3000, seed=1, image_ratio=0.1)
+    (tmp_path / 'out').mkdir()
+
+    r = subprocess.run([sys.executable, '-c', FAIL_ON_NTH_CALL, name, str(n), '-q', '--pipeline', '--index', '--thumbnails'],
+                       cwd=tmp_path, env={**os.environ, 'PYTHONPATH': str(HERE)}, capture_output=True, text=True, timeout=120)
+    assert r.returncode != 0
+    assert f'OSError: {name} failed' in r.stderr
+    assert not (tmp_path / 'out' / 'contacts.json').exists()
+    assert not (tmp_path / 'out' / 'contacts.db').exists()
+    assert list((tmp_path / 'out').glob('.*.tmp')) == []